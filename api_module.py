@@ -1,15 +1,117 @@
 # Purpose: This module contains functions for communicating with the API
+import asyncio
+import email.utils
 import json
 import logging
+import random
 import time
+from datetime import datetime as dt
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from cache_module import DiskCache, conditional_headers, exchange_rate_expiry, prices_cover_date, prices_expiry
+from metrics_module import increment, timed
+
+# Status codes worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# Pooled HTTP client shared by all API calls, with timeouts and one retry policy
+class HttpClient:
+    def __init__(self, connect_timeout=5, read_timeout=10, max_retries=3, backoff_base=1, backoff_cap=60,
+                 pool_maxsize=10, sleep=time.sleep):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.sleep = sleep
+        self.session = requests.Session()
+        # One keep-alive pool per host, so repeated calls to the same API reuse the connection
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # Seconds to wait before the next attempt: Retry-After if the server sent it, else jittered exponential backoff
+    def backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0), self.backoff_cap)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    # GET a URL, retrying connection errors and retryable statuses. Returns the last response.
+    # max_retries is the number of attempts, and at least one attempt is always made.
+    def get(self, url, headers=None, params=None, stream=False, max_retries=None):
+        max_retries = max(1, self.max_retries if max_retries is None else max_retries)
+        for attempt in range(max_retries):
+            last_attempt = attempt == max_retries - 1
+            try:
+                response = self.session.get(url, headers=headers, params=params, timeout=self.timeout,
+                                            stream=stream)
+            except requests.RequestException as e:
+                increment('http_errors', error=type(e).__name__)
+                if last_attempt:
+                    raise
+                increment('http_retries', reason='error')
+                delay = self.backoff_delay(attempt)
+                logging.warning(f"Request to {url} failed: {e}. Attempt {attempt + 1}. Retrying in {delay:.1f}s...")
+                self.sleep(delay)
+                continue
+
+            increment('http_responses', status=response.status_code)
+            if response.status_code == 429:
+                increment('http_rate_limited')
+            if response.status_code in RETRY_STATUSES and not last_attempt:
+                increment('http_retries', reason=response.status_code)
+                delay = self.backoff_delay(attempt, response)
+                if response.status_code == 429:
+                    logging.warning(f"Rate limit exceeded for {url}. Retrying in {delay:.1f}s...")
+                else:
+                    logging.warning(f"Request to {url} failed. Attempt {attempt + 1}. "
+                                    f"Status code: {response.status_code}. Retrying in {delay:.1f}s...")
+                response.close()
+                self.sleep(delay)
+                continue
+            return response
+
+    def close(self):
+        self.session.close()
+
+
+_default_client = None
+
+
+# Return the shared client, creating it with default settings on first use
+def default_client():
+    global _default_client
+    if _default_client is None:
+        _default_client = HttpClient()
+    return _default_client
+
+
+# Store a 200 response in the cache together with its validators
+def _cache_response(cache, key, response, payload, expires_at):
+    if cache is not None:
+        cache.put(key, payload, expires_at, response.headers.get('ETag'), response.headers.get('Last-Modified'))
 
 
 # Validate the API key for the exchange rate API
-def validate_exchange_rate_api_key(api_key, exchange_rate_api_url):
+def validate_exchange_rate_api_key(api_key, exchange_rate_api_url, cache=None, client=None):
+    entry = cache.get(DiskCache.make_key('fx', exchange_rate_api_url)) if cache else None
+    # A fresh cached rate was fetched with this key, so there is no need to ask again
+    if DiskCache.is_fresh(entry):
+        logging.info("Exchange rate API key validated by cached response.")
+        return True
     try:
-        response = requests.get(exchange_rate_api_url)
+        response = (client or default_client()).get(exchange_rate_api_url)
         if response.status_code == 401:
             logging.error("Invalid API key for the exchange rate API.")
             return False
@@ -20,61 +122,123 @@ def validate_exchange_rate_api_key(api_key, exchange_rate_api_url):
         return True
     except requests.RequestException as e:
         logging.error(f"An error occurred while validating the API key: {e}")
+        if entry:
+            logging.warning("Offline. Accepting the API key that produced the cached exchange rate.")
+            return True
         return False
 
 
 # Fetch the exchange rate from the API
-def fetch_exchange_rate(api_key, exchange_rate_api_url, max_retries=3):
-    for attempt in range(max_retries):
-        response = requests.get(exchange_rate_api_url)
+def fetch_exchange_rate(api_key, exchange_rate_api_url, max_retries=None, cache=None, client=None):
+    conversion_rate, _ = fetch_exchange_rate_checked(api_key, exchange_rate_api_url, max_retries, cache, client)
+    return conversion_rate
+
+
+# Fetch the exchange rate and validate the API key from the same response. Returns (rate, api_key_valid), where
+# api_key_valid is None when the API could not be reached and there is no cached rate to vouch for the key.
+@timed()
+def fetch_exchange_rate_checked(api_key, exchange_rate_api_url, max_retries=None, cache=None, client=None):
+    key = DiskCache.make_key('fx', exchange_rate_api_url)
+    entry = cache.get(key) if cache else None
+    if DiskCache.is_fresh(entry):
+        logging.info("Using cached exchange rate.")
+        return entry['payload']['rates']['EUR'], True
+
+    try:
+        response = (client or default_client()).get(exchange_rate_api_url, headers=conditional_headers(entry),
+                                                     max_retries=max_retries)
         status_code = response.status_code
 
         if status_code == 200:
             logging.info("Successfully fetched exchange rate.")
-            return response.json()['rates']['EUR']
+            payload = response.json()
+            _cache_response(cache, key, response, payload, exchange_rate_expiry(payload))
+            return payload['rates']['EUR'], True
+        elif status_code == 304 and entry:  # Not Modified
+            logging.info("Cached exchange rate is still valid.")
+            cache.revalidate(key, entry, exchange_rate_expiry(entry['payload']))
+            return entry['payload']['rates']['EUR'], True
         elif status_code == 401:  # Unauthorized
             logging.error("Unauthorized access to the exchange rate API. Check your API key.")
-            break
-        elif status_code == 429:  # Too Many Requests
-            logging.warning("Rate limit exceeded for the exchange rate API.")
-            time.sleep(60)  # Wait for 60 seconds before the next attempt
+            return None, False
         else:
-            logging.warning(f"Failed to fetch exchange rate. Attempt {attempt + 1}. Status code: {status_code}. "
-                            f"Retrying...")
-            time.sleep(2 ** attempt)
+            logging.error(f"Failed to fetch exchange rate. Status code: {status_code}.")
+    except (json.JSONDecodeError, KeyError) as e:
+        logging.error(f"Error while parsing the exchange rate response: {e}")
+    except requests.RequestException as e:
+        logging.error(f"An error occurred while fetching the exchange rate: {e}")
 
-    logging.info(f"Failed to fetch exchange rate after {max_retries} attempts.")
-    return None
+    logging.info("Failed to fetch exchange rate.")
+    if entry:
+        logging.warning("Using the last good exchange rate from the cache.")
+        return entry['payload']['rates']['EUR'], True
+    return None, None
 
 
 # Fetch the electricity prices from the API
-def fetch_electricity_prices(electricity_prices_api_url, max_retries=3):
-    response = None  # Initialize response to None
-    status_code = 'N/A'  # Initialize status_code to 'N/A'
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(electricity_prices_api_url)
-            status_code = response.status_code
-
-            if status_code == 200:
-                try:
-                    logging.info("Successfully fetched electricity prices.")
-                    return response.json(), status_code
-                except json.JSONDecodeError:
-                    logging.error("Error while parsing JSON response.")
-                    break
-            elif status_code == 401:  # Unauthorized
-                logging.error("Unauthorized access to the electricity prices API.")
-                break
-            elif status_code == 429:  # Too Many Requests
-                logging.warning("Rate limit exceeded for the electricity prices API.")
-                time.sleep(60)  # Wait for 60 seconds before the next attempt
-            else:
-                logging.warning(
-                    f"Failed to fetch electricity prices. Attempt {attempt + 1}. Status code: {status_code}. Retrying...")
-                time.sleep(2 ** attempt)
-        except requests.RequestException as e:
-            logging.error(f"An error occurred: {e}")
-
-    logging.error(f"Failed to fetch electricity prices after {max_retries} attempts.")
-    return None, status_code if response else 'N/A'
+@timed()
+def fetch_electricity_prices(electricity_prices_api_url, max_retries=None, cache=None, client=None):
+    # The URL is relative to the current day, so the cached prices are keyed by today's date
+    price_date = dt.now().date().isoformat()
+    key = DiskCache.make_key('prices', electricity_prices_api_url, price_date)
+    entry = cache.get(key) if cache else None
+    # An entry with another day's prices is never used, nor revalidated
+    if entry and not prices_cover_date(entry['payload'], price_date):
+        entry = None
+    if DiskCache.is_fresh(entry):
+        logging.info("Using cached electricity prices.")
+        return entry['payload'], 200
+
+    status_code = 'N/A'
+    try:
+        response = (client or default_client()).get(electricity_prices_api_url, headers=conditional_headers(entry),
+                                                     max_retries=max_retries)
+        status_code = response.status_code
+
+        if status_code == 200:
+            logging.info("Successfully fetched electricity prices.")
+            payload = response.json()
+            # Only cache once the day has been published, an empty day must be fetched again. Neither is another
+            # day's prices cached under today's key, e.g. when the server's day changed before or after ours.
+            if prices_cover_date(payload, price_date):
+                _cache_response(cache, key, response, payload, prices_expiry(payload))
+            elif payload.get('records'):
+                logging.warning(f"The electricity prices fetched are not for {price_date}, not caching them.")
+            return payload, status_code
+        elif status_code == 304 and entry:  # Not Modified
+            logging.info("Cached electricity prices are still valid.")
+            cache.revalidate(key, entry, prices_expiry(entry['payload']))
+            return entry['payload'], status_code
+        elif status_code == 401:  # Unauthorized
+            logging.error("Unauthorized access to the electricity prices API.")
+        else:
+            logging.error(f"Failed to fetch electricity prices. Status code: {status_code}.")
+    except json.JSONDecodeError:
+        logging.error("Error while parsing JSON response.")
+    except requests.RequestException as e:
+        logging.error(f"An error occurred: {e}")
+
+    logging.error("Failed to fetch electricity prices.")
+    if entry:
+        logging.warning("Using the last good electricity prices from the cache.")
+        return entry['payload'], status_code
+    return None, status_code
+
+
+# Fetch the exchange rate and the electricity prices concurrently.
+# Returns (api_key_valid, conversion_rate, data, status_code).
+@timed()
+async def fetch_startup_data_async(api_key, exchange_rate_api_url, electricity_prices_api_url, max_retries=None,
+                                   cache=None, client=None):
+    (conversion_rate, api_key_valid), (data, status_code) = await asyncio.gather(
+        asyncio.to_thread(fetch_exchange_rate_checked, api_key, exchange_rate_api_url, max_retries, cache, client),
+        asyncio.to_thread(fetch_electricity_prices, electricity_prices_api_url, max_retries, cache, client),
+    )
+    return api_key_valid, conversion_rate, data, status_code
+
+
+# Synchronous wrapper around fetch_startup_data_async for callers without an event loop
+def fetch_startup_data(api_key, exchange_rate_api_url, electricity_prices_api_url, max_retries=None, cache=None,
+                       client=None):
+    return asyncio.run(fetch_startup_data_async(api_key, exchange_rate_api_url, electricity_prices_api_url,
+                                                max_retries, cache, client))
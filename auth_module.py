@@ -0,0 +1,9 @@
+# Purpose: Identify the computer running the program, for the authorization check at startup.
+# Only needs the standard library, so the check does not wait for pandas or requests to load.
+import uuid
+
+
+# Get the MAC address of the computer running the program
+def get_mac_address():
+    mac = uuid.UUID(int=uuid.getnode()).hex[-12:]
+    return ":".join([mac[e:e + 2] for e in range(0, 11, 2)])
@@ -0,0 +1,159 @@
+# Purpose: Backtest the percentile thresholds on historical prices, to choose the x/y percentiles with data.
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from data_processing_module import calculate_statistics_by_day, infer_resolution
+from metrics_module import timed
+
+# Percentiles swept by default, for both x and y
+GRID_STEPS = tuple(round(step * 0.05, 2) for step in range(1, 20))
+
+# Percentile pairs simulated at a time. Each pair needs a few arrays as long as the price history.
+BACKTEST_CHUNK_SIZE = 32
+
+
+# Return the (x, y) pairs of the grid. Pairs where the on threshold (the y-percentile) would be above the off
+# threshold (the (1 - x)-percentile) are left out, as the load would switch on and off on the same prices.
+def percentile_grid(x_values=GRID_STEPS, y_values=GRID_STEPS):
+    return [(float(x), float(y)) for x in x_values for y in y_values if y <= round(1 - x, 10)]
+
+
+# Return the prices sorted per price area by time, the start of each area's segment and the area names
+def price_segments(prices_df):
+    time_column = 'HourUTC' if 'HourUTC' in prices_df else 'HourDK'
+    if 'PriceArea' not in prices_df:
+        return prices_df.sort_values(time_column, ignore_index=True), np.array([0]), [None]
+    prices_df = prices_df.sort_values(['PriceArea', time_column], ignore_index=True)
+    areas = pd.Categorical(prices_df['PriceArea'])
+    is_start = np.ones(len(prices_df), dtype=bool)
+    is_start[1:] = areas.codes[1:] != areas.codes[:-1]
+    starts = np.flatnonzero(is_start)
+    return prices_df, starts, [str(area) for area in areas[starts]]
+
+
+# Return one row per percentile level with that day's threshold for every slot. The thresholds are the per-day
+# quantiles of calculate_statistics_by_day, interpolated the same way as calculate_percentiles.
+def slot_thresholds(prices_df, levels):
+    stats = calculate_statistics_by_day(prices_df, levels)
+    slot_keys = [prices_df['HourDK'].to_numpy().astype('datetime64[D]')]
+    if isinstance(stats.index, pd.MultiIndex):
+        slot_keys.insert(0, prices_df['PriceArea'].astype(str).to_numpy())
+        stats.index = stats.index.set_levels(stats.index.levels[0].astype(str), level=0)
+        slot_index = pd.MultiIndex.from_arrays(slot_keys, names=stats.index.names)
+    else:
+        slot_index = pd.Index(slot_keys[0], name=stats.index.name)
+    per_slot = stats.reindex(slot_index)
+    return np.vstack([per_slot[f'q{level}'].to_numpy(dtype='float64') for level in levels])
+
+
+# Simulate the load for pairs of threshold rows. Per pair, the load switches on at a price below its on threshold,
+# off at a price above its off threshold, and otherwise keeps its state, starting off in each area segment.
+# The state is a forward fill of the last switching event, done for all pairs at once with a running maximum.
+# Returns arrays (pairs, segments) of the slots on, the sum of the prices while on and the number of starts.
+def simulate_switching(prices, thresholds, on_rows, off_rows, segment_starts):
+    slots = np.arange(len(prices))
+    switch_off = prices > thresholds[off_rows]
+    switch_on = (prices < thresholds[on_rows]) & ~switch_off
+    event = switch_on | switch_off
+    event[:, segment_starts] = True
+    last_event = np.maximum.accumulate(np.where(event, slots, 0), axis=1)
+    on = np.take_along_axis(switch_on, last_event, axis=1)
+
+    started = on.copy()
+    started[:, 1:] &= ~on[:, :-1]
+    started[:, segment_starts] = on[:, segment_starts]
+    on_prices = np.where(on, np.nan_to_num(prices), 0.0)
+    return (np.add.reduceat(on, segment_starts, axis=1), np.add.reduceat(on_prices, segment_starts, axis=1),
+            np.add.reduceat(started, segment_starts, axis=1))
+
+
+# Replay the prices for every (x, y) pair of the grid, with the daily x/y percentiles as the PLC would get them,
+# and return a DataFrame with the runtime hours, cost in EUR for a load of load_kw, average price while on
+# (EUR/MWh) and number of starts per pair and price area. processes > 1 spreads the grid over worker processes.
+@timed()
+def backtest_percentiles(prices_df, grid=None, load_kw=1.0, processes=None, chunk_size=BACKTEST_CHUNK_SIZE):
+    grid = percentile_grid() if grid is None else [(float(x), float(y)) for x, y in grid]
+    prices_df, segment_starts, areas = price_segments(prices_df)
+    slot_hours = infer_resolution(prices_df) / pd.Timedelta(hours=1)
+
+    # Each pair needs the (1 - x)- and y-percentiles; every level is computed once for the whole grid
+    levels = sorted({round(1 - x, 10) for x, _ in grid} | {round(y, 10) for _, y in grid})
+    level_rows = {level: row for row, level in enumerate(levels)}
+    thresholds = slot_thresholds(prices_df, levels)
+    on_rows = np.array([level_rows[round(y, 10)] for _, y in grid], dtype=np.int64)
+    off_rows = np.array([level_rows[round(1 - x, 10)] for x, _ in grid], dtype=np.int64)
+    prices = prices_df['SpotPriceEUR'].to_numpy(dtype='float64')
+
+    chunks = [(prices, thresholds, on_rows[start:start + chunk_size], off_rows[start:start + chunk_size],
+               segment_starts) for start in range(0, len(grid), chunk_size)]
+    if processes and processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(simulate_switching, *zip(*chunks)))
+    else:
+        results = [simulate_switching(*chunk) for chunk in chunks]
+    on_slots, on_price_sums, starts = (np.concatenate(arrays) for arrays in zip(*results)) if results else \
+        (np.empty((0, len(areas))),) * 3
+
+    runtime_hours = on_slots * slot_hours
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average_price = np.where(on_slots > 0, on_price_sums / on_slots, np.nan)
+    results_df = pd.DataFrame({
+        'PriceArea': np.repeat([areas], len(grid), axis=0).ravel(),
+        'x': np.repeat([x for x, _ in grid], len(areas)),
+        'y': np.repeat([y for _, y in grid], len(areas)),
+        'runtime_hours': runtime_hours.ravel(),
+        'cost_eur': (on_price_sums * slot_hours * load_kw / 1000).ravel(),
+        'average_price': average_price.ravel(),
+        'starts': starts.ravel().astype(np.int64),
+    })
+    if areas == [None]:
+        results_df = results_df.drop(columns='PriceArea')
+    logging.info(f"Backtested {len(grid)} percentile pairs on {len(prices)} prices.")
+    return results_df
+
+
+# Backtest the grid on the prices in the price history for [start, end), fetching missing days first if update
+def backtest_history(start, end, areas=('DK1',), grid=None, load_kw=1.0, processes=None, update=False, store=None):
+    from history_module import PriceHistoryStore
+
+    store = store or PriceHistoryStore()
+    if update:
+        store.update(start, end, areas=list(areas))
+    prices_df = store.query(start, end, areas=list(areas))
+    if prices_df.empty:
+        logging.warning(f"No price history for {list(areas)} from {start} to {end}.")
+        return None
+    return backtest_percentiles(prices_df, grid, load_kw, processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest the x/y percentile thresholds on the price history.")
+    parser.add_argument('start', type=date.fromisoformat, help="first day, e.g. 2024-01-01")
+    parser.add_argument('end', type=date.fromisoformat, help="day after the last day, e.g. 2025-01-01")
+    parser.add_argument('--areas', nargs='+', default=['DK1'])
+    parser.add_argument('--load-kw', type=float, default=1.0, help="power of the simulated load in kW")
+    parser.add_argument('--min-runtime', type=float, default=0,
+                        help="only show pairs running the load at least this many hours per day")
+    parser.add_argument('--top', type=int, default=20, help="number of pairs shown per price area")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes for the grid")
+    parser.add_argument('--update', action='store_true', help="fetch missing days into the price history first")
+    args = parser.parse_args()
+
+    results_df = backtest_history(args.start, args.end, args.areas, load_kw=args.load_kw,
+                                  processes=args.processes, update=args.update)
+    if results_df is None:
+        parser.exit(1, f"No price history from {args.start} to {args.end}. Run with --update to fetch it.\n")
+    days = (args.end - args.start).days
+    results_df['hours_per_day'] = results_df['runtime_hours'] / days
+    results_df = results_df[results_df['hours_per_day'] >= args.min_runtime]
+    results_df = results_df.sort_values(['PriceArea', 'average_price']).groupby('PriceArea').head(args.top)
+    print(results_df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
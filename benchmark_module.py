@@ -0,0 +1,172 @@
+# Purpose: Benchmarks comparing the data processing with its original implementation, and the import times.
+# Run with: python benchmark_module.py. The pipeline, PLC write and fetch benchmarks are in benchmarks/.
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+import timeit
+from datetime import datetime as dt, timedelta
+
+import pandas as pd
+
+from data_processing_module import *
+
+# Number of days of records for each benchmark size
+BENCHMARK_SIZES = {'1 day': 1, '1 month': 31, '1 year': 365}
+
+# Exchange rate used for the synthetic payloads
+CONVERSION_RATE = 0.134
+
+
+# Build a synthetic API payload with records for n_days (or n_slots price intervals), ending with the current day
+def make_price_records(n_days, areas=('DK1',), resolution=timedelta(hours=1), n_slots=None):
+    n_slots = n_slots or int(n_days * timedelta(days=1) / resolution)
+    first_slot = dt.combine(dt.now().date() + timedelta(days=1), dt.min.time()) - n_slots * resolution
+    records = []
+    for slot in range(n_slots):
+        timestamp = first_slot + slot * resolution
+        for area in areas:
+            records.append({
+                'HourUTC': (timestamp - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S'),
+                'HourDK': timestamp.strftime('%Y-%m-%dT%H:%M:%S'),
+                'PriceArea': area,
+                'SpotPriceDKK': 500.0 + (slot * 37) % 400,
+            })
+    return {'records': records}
+
+
+# The original process_data implementation, kept as the benchmark baseline
+def legacy_process_data(data, conversion_rate_dkk_to_eur):
+    records = data['records']
+    prices_df = pd.DataFrame(records)
+    prices_df = prices_df[['HourDK', 'SpotPriceDKK']]
+    prices_df['HourDK'] = pd.to_datetime(prices_df['HourDK'])
+    current_date = dt.now().date()
+    prices_df = prices_df[prices_df['HourDK'].dt.date == current_date]
+    if conversion_rate_dkk_to_eur:
+        prices_df['SpotPriceEUR'] = prices_df['SpotPriceDKK'] * conversion_rate_dkk_to_eur
+    return prices_df
+
+
+# Return the best time in milliseconds per call over the repeats
+def time_call(function, repeat=5):
+    number = 1
+    timer = timeit.Timer(function)
+    # Run cheap functions several times per repeat so the timer resolution does not matter
+    while timer.timeit(number) < 0.05 and number < 10000:
+        number *= 10
+    return min(timer.repeat(repeat, number)) / number * 1000
+
+
+# Compare process_data against the original implementation
+def benchmark_process_data(repeat=5):
+    results = []
+    for label, n_days in BENCHMARK_SIZES.items():
+        data = make_price_records(n_days)
+        legacy_ms = time_call(lambda: legacy_process_data(data, CONVERSION_RATE), repeat)
+        current_ms = time_call(lambda: process_data(data, CONVERSION_RATE), repeat)
+        results.append({'benchmark': f'process_data ({label})', 'records': len(data['records']),
+                        'legacy_ms': round(legacy_ms, 3), 'current_ms': round(current_ms, 3),
+                        'speedup': round(legacy_ms / current_ms, 1)})
+    return results
+
+
+# Compare the separate statistics scans with the single-pass statistics engine
+def benchmark_statistics(repeat=5, quantiles=(0.1, 0.25, 0.33, 0.5, 0.66, 0.75, 0.9)):
+    results = []
+    for label, n_days in BENCHMARK_SIZES.items():
+        today = dt.now().date()
+        prices_df = process_data(make_price_records(n_days), CONVERSION_RATE,
+                                 start=today - timedelta(days=n_days - 1), end=today + timedelta(days=1))
+
+        def separate_scans():
+            calculate_price_difference(prices_df)
+            calculate_daily_average(prices_df)
+            get_current_hour_prices(prices_df)
+            for quantile in quantiles:
+                prices_df['SpotPriceEUR'].quantile(quantile)
+
+        # Clear the statistics cache before each call, so the engine itself is timed
+        def uncached_statistics():
+            STATISTICS_CACHE.clear()
+            calculate_daily_statistics(prices_df, quantiles)
+
+        legacy_ms = time_call(separate_scans, repeat)
+        current_ms = time_call(uncached_statistics, repeat)
+        cached_ms = time_call(lambda: calculate_daily_statistics(prices_df, quantiles), repeat)
+        results.append({'benchmark': f'statistics ({label})', 'records': len(prices_df),
+                        'legacy_ms': round(legacy_ms, 3), 'current_ms': round(current_ms, 3),
+                        'speedup': round(legacy_ms / current_ms, 1), 'cached_ms': round(cached_ms, 3)})
+    return results
+
+
+# Modules whose import time is measured: the CLI entry point, the modules it imports before showing the menu,
+# and the modules it only imports when an option needs them
+IMPORT_TARGETS = ('main', 'api_module', 'data_processing_module', 'service_module', 'plc_module', 'excel_module')
+
+# One line of `python -X importtime` output: self and cumulative microseconds, then the indented module name
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+# Parse `python -X importtime` output into (module, depth, self_us, cumulative_us) tuples, in output order
+def parse_import_times(output):
+    imports = []
+    for line in output.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append((module, (len(indent) - 1) // 2, int(self_us), int(cumulative_us)))
+    return imports
+
+
+# Import a module in a fresh interpreter and return its import time in ms and its direct imports by cumulative ms
+def measure_import_time(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                            check=True)
+    imports = parse_import_times(result.stderr)
+    # A module's own imports are listed before it, at one level deeper
+    end = next(index for index, (name, depth, _, _) in enumerate(imports) if name == module and depth == 0)
+    start = next((index + 1 for index in range(end - 1, -1, -1) if imports[index][1] == 0), 0)
+    children = {name: cumulative_us / 1000 for name, depth, _, cumulative_us in imports[start:end] if depth == 1}
+    return imports[end][3] / 1000, children
+
+
+# Measure the import time of the entry point and the lazily imported modules, each in a fresh interpreter
+def benchmark_import_time(repeat=5, top=3):
+    results = []
+    for module in IMPORT_TARGETS:
+        measurements = [measure_import_time(module) for _ in range(repeat)]
+        import_ms, children = min(measurements, key=lambda measurement: measurement[0])
+        slowest = sorted(children.items(), key=lambda child: child[1], reverse=True)[:top]
+        results.append({'benchmark': f'import {module}', 'import_ms': round(import_ms, 1),
+                        'slowest_imports': ', '.join(f'{name} {ms:.0f}ms' for name, ms in slowest)})
+    return results
+
+
+BENCHMARKS = {
+    'process_data': benchmark_process_data,
+    'statistics': benchmark_statistics,
+    'import_time': benchmark_import_time,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the spot price benchmarks.")
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f"benchmarks to run, one of {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    logging.disable(logging.CRITICAL)
+    for name in args.benchmarks or BENCHMARKS:
+        print(pd.DataFrame(BENCHMARKS[name](args.repeat)).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
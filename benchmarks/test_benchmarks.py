@@ -0,0 +1,153 @@
+# pytest-benchmark suite for the processing chain, the PLC writes and the price fetches.
+# Run with `python -m pytest benchmarks`; see the Benchmarks section of the README for the regression gate.
+# The local pymodbus and HTTP servers are the modbus_server and http_server fixtures of conftest.py.
+import asyncio
+from datetime import datetime as dt, timedelta
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from benchmark_module import CONVERSION_RATE, make_price_records
+from data_processing_module import (STATISTICS_CACHE, calculate_daily_average, calculate_percentiles,
+                                    calculate_price_difference, get_current_hour_prices, process_data)
+
+# Record counts of the pipeline benchmarks and their price resolution: one day and about a year of hourly and
+# quarter-hour prices
+PIPELINE_SIZES = {24: timedelta(hours=1), 96: timedelta(minutes=15), 2400: timedelta(hours=1),
+                  35000: timedelta(minutes=15)}
+
+# Record counts of the price fetch benchmarks
+FETCH_SIZES = (24, 2400, 35000)
+
+# Price signals of a typical day, as written by the PLC option
+SIGNALS = {'price_difference': 308.2, 'average_price': 154.1, 'current_price': 26.8, 'min_percentile': 101.71,
+           'max_percentile': 104.79}
+
+
+# Synthetic API payload and its processed prices for each pipeline size: (data, start, end, prices_df)
+@pytest.fixture(scope='module', params=list(PIPELINE_SIZES), ids=lambda n_records: f'{n_records} records')
+def pipeline_data(request):
+    data = make_price_records(0, resolution=PIPELINE_SIZES[request.param], n_slots=request.param)
+    start = dt.fromisoformat(data['records'][0]['HourDK']).date()
+    end = dt.now().date() + timedelta(days=1)
+    return data, start, end, process_data(data, CONVERSION_RATE, start=start, end=end)
+
+
+def test_process_data(benchmark, pipeline_data):
+    data, start, end, _ = pipeline_data
+    benchmark.group = 'process_data'
+    benchmark(process_data, data, CONVERSION_RATE, start=start, end=end)
+
+
+def test_calculate_percentiles(benchmark, pipeline_data):
+    prices_df = pipeline_data[3]
+
+    def uncached_percentiles():
+        STATISTICS_CACHE.clear()
+        return calculate_percentiles(prices_df, 0.66, 0.33)
+
+    benchmark.group = 'calculate_percentiles'
+    benchmark(uncached_percentiles)
+
+
+def test_calculate_percentiles_cached(benchmark, pipeline_data):
+    benchmark.group = 'calculate_percentiles (cached)'
+    benchmark(calculate_percentiles, pipeline_data[3], 0.66, 0.33)
+
+
+def test_calculate_price_difference(benchmark, pipeline_data):
+    benchmark.group = 'calculate_price_difference'
+    benchmark(calculate_price_difference, pipeline_data[3])
+
+
+def test_calculate_daily_average(benchmark, pipeline_data):
+    benchmark.group = 'calculate_daily_average'
+    benchmark(calculate_daily_average, pipeline_data[3])
+
+
+def test_get_current_hour_prices(benchmark, pipeline_data):
+    benchmark.group = 'get_current_hour_prices'
+    benchmark(get_current_hour_prices, pipeline_data[3])
+
+
+# The original path: one write_register call per register, and write_data_to_plc closes the client each time
+def test_write_data_to_plc(benchmark, modbus_server):
+    from plc_module import map_signals_to_registers, setup_plc_client, write_data_to_plc
+
+    registers = map_signals_to_registers(SIGNALS)
+    client = setup_plc_client('127.0.0.1', modbus_server.port)
+
+    def legacy_writes():
+        for address, value in registers.items():
+            assert write_data_to_plc(client, address, value, 100)
+
+    benchmark.group = 'plc_write'
+    try:
+        benchmark(legacy_writes)
+    finally:
+        client.close()
+
+
+def test_plc_register_writer(benchmark, modbus_server):
+    from plc_module import AsyncPlcRegisterWriter, map_signals_to_registers
+
+    registers = map_signals_to_registers(SIGNALS)
+
+    async def connected_writer():
+        writer = AsyncPlcRegisterWriter('127.0.0.1', modbus_server.port)
+        await writer.connect()
+        return writer
+
+    loop = asyncio.new_event_loop()
+    writer = loop.run_until_complete(connected_writer())
+    benchmark.group = 'plc_write'
+    try:
+        assert benchmark(lambda: loop.run_until_complete(writer.write_registers(registers, force=True)))
+    finally:
+        loop.run_until_complete(writer.close())
+        loop.close()
+
+
+# The PLC option of the menu: connect, write all signals and close, as handle_plc_option does
+def test_write_signals_to_targets(benchmark, modbus_server):
+    from plc_module import plc_targets_from_config, write_signals_to_targets
+
+    targets = plc_targets_from_config([], '127.0.0.1', modbus_server.port)
+    benchmark.group = 'plc_write'
+    results = benchmark(write_signals_to_targets, targets, SIGNALS)
+    assert all(results.values())
+
+
+# URL of the local stub serving a price payload of each fetch size
+@pytest.fixture(params=FETCH_SIZES, ids=lambda n_records: f'{n_records} records')
+def prices_url(request, http_server):
+    http_server.respond(200, make_price_records(0, n_slots=request.param))
+    return http_server.url + 'dataset/Elspotprices', request.param
+
+
+@pytest.fixture(scope='module')
+def http_client():
+    from api_module import HttpClient
+
+    client = HttpClient(max_retries=1)
+    yield client
+    client.close()
+
+
+def test_fetch_electricity_prices(benchmark, prices_url, http_client):
+    from api_module import fetch_electricity_prices
+
+    url, n_records = prices_url
+    benchmark.group = 'fetch_electricity_prices'
+    data, status_code = benchmark(fetch_electricity_prices, url, client=http_client)
+    assert status_code == 200 and len(data['records']) == n_records
+
+
+def test_fetch_price_columns(benchmark, prices_url, http_client):
+    from streaming_module import fetch_price_columns
+
+    url, n_records = prices_url
+    benchmark.group = 'fetch_price_columns'
+    prices_df = benchmark(fetch_price_columns, url, {}, http_client, page_size=n_records + 1)
+    assert len(prices_df) == n_records
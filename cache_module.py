@@ -0,0 +1,162 @@
+# Purpose: Persistent on-disk cache for API responses and user settings.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime as dt, timedelta
+
+# Directory the cache files are stored in
+CACHE_DIR = 'cache'
+
+# File holding user settings such as the last used percentiles
+SETTINGS_FILE = 'settings.json'
+
+
+# Day-ahead prices never change once published, so they never expire
+def prices_expiry(payload):
+    return None
+
+
+# Return whether a price payload has records for the price date (YYYY-MM-DD), by their TimeDK or HourDK
+def prices_cover_date(payload, price_date):
+    for record in payload.get('records') or ():
+        timestamp = record.get('TimeDK') or record.get('HourDK')
+        if timestamp and timestamp[:10] == price_date:
+            return True
+    return False
+
+
+# The exchange rate is refreshed daily, so it expires at the next local midnight
+def exchange_rate_expiry(payload):
+    tomorrow = dt.now().date() + timedelta(days=1)
+    return dt.combine(tomorrow, dt.min.time()).timestamp()
+
+
+# Build the conditional request headers for revalidating a cached entry
+def conditional_headers(entry):
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+# Cache of API responses keyed by source, URL and price date, stored as one JSON file per entry
+class DiskCache:
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    # Build the cache key for a source, URL and (optional) price date
+    @staticmethod
+    def make_key(source, url, price_date=None):
+        digest = hashlib.sha256(f"{url}|{price_date or ''}".encode('utf-8')).hexdigest()[:16]
+        return f"{source}-{price_date}-{digest}" if price_date else f"{source}-{digest}"
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    # Write JSON atomically so a crash never leaves a half-written file behind
+    def _write_json(self, name, data):
+        tmp_path = self._path(name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self._path(name))
+
+    def _read_json(self, name):
+        try:
+            with open(self._path(name), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (PermissionError, json.JSONDecodeError) as e:
+            logging.error(f"Error while reading cache file {name}: {e}")
+            return None
+
+    # Return the cached entry for a key, or None if there is none
+    def get(self, key):
+        return self._read_json(key + '.json')
+
+    # Store a payload with its expiry time (None = never expires) and validators
+    def put(self, key, payload, expires_at=None, etag=None, last_modified=None):
+        entry = {
+            'payload': payload,
+            'fetched_at': time.time(),
+            'expires_at': expires_at,
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+        try:
+            self._write_json(key + '.json', entry)
+        except (OSError, TypeError) as e:
+            logging.error(f"Error while writing cache entry {key}: {e}")
+        return entry
+
+    # Extend the expiry of an entry after the server confirmed it is unchanged (304)
+    def revalidate(self, key, entry, expires_at=None):
+        return self.put(key, entry['payload'], expires_at, entry.get('etag'), entry.get('last_modified'))
+
+    @staticmethod
+    def is_fresh(entry, now=None):
+        if entry is None:
+            return False
+        expires_at = entry.get('expires_at')
+        return expires_at is None or (now or time.time()) < expires_at
+
+    # Delete entries that were fetched more than max_age_days ago
+    def prune(self, max_age_days=30):
+        cutoff = time.time() - max_age_days * 86400
+        for name in os.listdir(self.directory):
+            if name == SETTINGS_FILE or not name.endswith('.json'):
+                continue
+            entry = self._read_json(name)
+            if entry is None or entry.get('fetched_at', 0) < cutoff:
+                try:
+                    os.remove(self._path(name))
+                except OSError as e:
+                    logging.warning(f"Could not remove cache file {name}: {e}")
+
+    # Load a user setting, or return the default if it has not been saved
+    def load_setting(self, name, default=None):
+        settings = self._read_json(SETTINGS_FILE) or {}
+        return settings.get(name, default)
+
+    def save_setting(self, name, value):
+        settings = self._read_json(SETTINGS_FILE) or {}
+        settings[name] = value
+        self._write_json(SETTINGS_FILE, settings)
+
+
+# Bounded in-memory cache that evicts the least recently used entry. Safe to share between threads.
+class LruCache:
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Return the cached value for the key and mark it as recently used, or the default if it is not cached
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -1,6 +1,61 @@
 # Purpose: Setup logging for the application and read the config file.
+# The config file is only read when a config value is first used, so importing this module is free.
 import json
 
+# Marks config values that have no default and must be in config.json
+REQUIRED = object()
+
+# Config value names and their config.json key and default
+CONFIG_VALUES = {
+    # Get config values
+    'AUTHORIZED_IDS': ('AUTHORIZED_IDS', REQUIRED),
+    'api_key': ('API_KEY', REQUIRED),
+    'max_retries': ('MAX_RETRIES', REQUIRED),
+    'timeout': ('TIMEOUT', REQUIRED),
+    'connect_timeout': ('CONNECT_TIMEOUT', 5),
+    'exchange_rate_api_url': ('EXCHANGE_RATE_API_URL', REQUIRED),
+    'electricity_prices_api_url': ('ELECTRICITY_PRICES_API_URL', REQUIRED),
+
+    # PLC config
+    'scaling_factor': ('SCALING_FACTOR', REQUIRED),
+    'unit_id': ('UNIT_ID', REQUIRED),
+    'plc_host': ('PLC_HOST', '192.168.127.254'),
+    'plc_port': ('PLC_PORT', 502),
+    'plc_deadband': ('PLC_DEADBAND', 0),
+    'plc_verify_on_connect': ('PLC_VERIFY_ON_CONNECT', False),
+    'plc_timeout': ('PLC_TIMEOUT', 3),
+    'plc_keepalive_interval': ('PLC_KEEPALIVE_INTERVAL', 30),
+
+    # Optional list of PLC gateways that all receive the price signals. Empty means only the gateway above.
+    'plc_targets': ('PLC_TARGETS', []),
+    'plc_max_concurrency': ('PLC_MAX_CONCURRENCY', 8),
+
+    # Service config
+    'percentile_max': ('PERCENTILE_MAX', 0.66),
+    'percentile_min': ('PERCENTILE_MIN', 0.33),
+
+    # Optional load schedule written to the PLC by the service
+    'schedule_config': ('SCHEDULE', None),
+
+    # Formats of the daily archive exported by the service. Empty disables the archive.
+    'archive_formats': ('ARCHIVE_FORMATS', []),
+    'archive_dir': ('ARCHIVE_DIR', 'archive'),
+
+    # Logging and metrics. The metrics endpoint and file are disabled when not set.
+    'log_format': ('LOG_FORMAT', 'json'),
+    'metrics_port': ('METRICS_PORT', None),
+    'metrics_file': ('METRICS_FILE', None),
+
+    # Read-only Modbus TCP server for SCADA/HMI clients, run by the service. Disabled when no port is set.
+    'modbus_server_host': ('MODBUS_SERVER_HOST', '127.0.0.1'),
+    'modbus_server_port': ('MODBUS_SERVER_PORT', None),
+}
+
+# `from config_module import *` still gives every config value, reading the config file at that point
+__all__ = ['read_config', 'config', *CONFIG_VALUES]
+
+_config = None
+
 
 # Read config file
 def read_config(filename='config.json'):
@@ -13,16 +68,21 @@ def read_config(filename='config.json'):
         raise
 
 
-config = read_config()
+# Return the config, reading the config file on first use
+def get_config():
+    global _config
+    if _config is None:
+        _config = read_config()
+    return _config
 
-# Get config values
-AUTHORIZED_IDS = config['AUTHORIZED_IDS']
-api_key = config['API_KEY']
-max_retries = config['MAX_RETRIES']
-timeout = config['TIMEOUT']
-exchange_rate_api_url = config['EXCHANGE_RATE_API_URL']
-electricity_prices_api_url = config['ELECTRICITY_PRICES_API_URL']
 
-# PLC config
-scaling_factor = config['SCALING_FACTOR']
-unit_id = config['UNIT_ID']
+# Look config values up on first access, e.g. config_module.api_key
+def __getattr__(name):
+    if name == 'config':
+        return get_config()
+    if name not in CONFIG_VALUES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    key, default = CONFIG_VALUES[name]
+    if default is REQUIRED:
+        return get_config()[key]
+    return get_config().get(key, default)
@@ -0,0 +1,128 @@
+# Purpose: Shared fixtures for the tests and the benchmarks: a local pymodbus server to write the PLC registers to,
+# and a local HTTP server standing in for the APIs.
+import asyncio
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext, ModbusSlaveContext
+from pymodbus.server import ModbusTcpServer
+
+
+# Return a TCP port on localhost that is free right now
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Data block that counts the write requests it receives
+class CountingDataBlock(ModbusSequentialDataBlock):
+    def __init__(self, address, values):
+        super().__init__(address, values)
+        self.writes = 0
+
+    def setValues(self, address, values):
+        self.writes += 1
+        super().setValues(address, values)
+
+
+# pymodbus TCP server on a free localhost port, run on its own event loop thread so it can be stopped and started
+# again on the same port while a test's client keeps running
+class LocalModbusServer:
+    def __init__(self, size=200):
+        self.port = free_port()
+        self.registers = CountingDataBlock(0, [0] * size)
+        self.coils = CountingDataBlock(0, [False] * size)
+        self.context = ModbusServerContext(slaves=ModbusSlaveContext(hr=self.registers, co=self.coils,
+                                                                     zero_mode=True), single=True)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = None
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout=5)
+
+    def start(self):
+        async def listen():
+            self.server = ModbusTcpServer(self.context, address=('127.0.0.1', self.port))
+            if not await self.server.listen():
+                raise OSError(f"Could not start the test Modbus server on port {self.port}.")
+
+        self._run(listen())
+
+    def stop(self):
+        if self.server is not None:
+            self._run(self.server.shutdown())
+            self.server = None
+
+    def close(self):
+        self.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        self.loop.close()
+
+
+@pytest.fixture
+def modbus_server():
+    server = LocalModbusServer()
+    server.start()
+    yield server
+    server.close()
+
+
+# A localhost port nothing listens on, to test unreachable PLCs
+@pytest.fixture
+def closed_port():
+    return free_port()
+
+
+# Answers each GET with the next scripted response of its StubHttpServer
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stub = self.server.stub
+        stub.requests.append((self.path, dict(self.headers)))
+        status, headers, body = stub.responses[min(len(stub.requests), len(stub.responses)) - 1]
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Local HTTP server answering each GET with the next scripted response, repeating the last one when the script
+# runs out. The requests are recorded as (path, headers).
+class StubHttpServer:
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.stub = self
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    # Add a response to the script. A dict or list body is sent as JSON.
+    def respond(self, status=200, body=b'', headers=None):
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        self.responses.append((status, headers, body))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def http_server():
+    server = StubHttpServer()
+    yield server
+    server.close()
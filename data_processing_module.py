@@ -1,64 +1,272 @@
 # Purpose: This module contains functions for processing the data from the API and calculating the statistics.
+import hashlib
 import logging
-import pickle
-import uuid
+from collections import namedtuple
 from datetime import datetime as dt
 
+import numpy as np
 import pandas as pd
 
+from cache_module import DiskCache, LruCache
+from metrics_module import increment, timed
 
-# Process the data from the API into a DataFrame and return it if successful
-def process_data(data, conversion_rate_dkk_to_eur):
+
+# Optional columns kept from the API records when they are present
+OPTIONAL_COLUMNS = ('HourUTC', 'PriceArea')
+
+# Column names of the quarter-hour DayAheadPrices dataset, mapped to the Elspotprices names used throughout.
+# HourDK/HourUTC keep their names but hold the interval start at any resolution.
+COLUMN_ALIASES = {'TimeDK': 'HourDK', 'TimeUTC': 'HourUTC', 'DayAheadPriceDKK': 'SpotPriceDKK',
+                  'DayAheadPriceEUR': 'SpotPriceEUR'}
+
+# Resolution assumed when it cannot be inferred from the data
+DEFAULT_RESOLUTION = pd.Timedelta(hours=1)
+
+
+# Return the record key holding each column, so both the hourly and the quarter-hour dataset can be read
+def source_keys(record):
+    keys = {column: column for column in record}
+    keys.update({alias: key for key, alias in COLUMN_ALIASES.items() if key in record})
+    return keys
+
+
+# Process the data from the API into a DataFrame and return it if successful.
+# Only the records with HourDK in [start, end) are kept, which defaults to the current day.
+@timed()
+def process_data(data, conversion_rate_dkk_to_eur, start=None, end=None):
     try:
         records = data['records']
-        prices_df = pd.DataFrame(records)
-        prices_df = prices_df[['HourDK', 'SpotPriceDKK']]
-        # Convert HourDK to datetime
-        prices_df['HourDK'] = pd.to_datetime(prices_df['HourDK'])
+        start = pd.Timestamp(start or dt.now().date()).to_datetime64()
+        end = pd.Timestamp(end).to_datetime64() if end else start + np.timedelta64(1, 'D')
+        keys = source_keys(records[0]) if records else {'HourDK': 'HourDK', 'SpotPriceDKK': 'SpotPriceDKK'}
+
+        # Parse the ISO timestamps once, straight into datetime64, and filter on the range bounds
+        hours = np.array([record[keys['HourDK']] for record in records], dtype='datetime64[s]')
+        in_range = (hours >= start) & (hours < end)
 
-        # Filter records to keep only those from the current day
-        current_date = dt.now().date()
-        prices_df = prices_df[prices_df['HourDK'].dt.date == current_date]
+        price_key = keys['SpotPriceDKK']
+        columns = {
+            'HourDK': hours[in_range].astype('datetime64[ns]'),
+            'SpotPriceDKK': np.array([record[price_key] for record in records], dtype='float64')[in_range],
+        }
+        for column in OPTIONAL_COLUMNS:
+            if column in keys:
+                values = [record[keys[column]] for record in records]
+                if column == 'HourUTC':
+                    columns[column] = np.array(values, dtype='datetime64[s]')[in_range].astype('datetime64[ns]')
+                else:
+                    columns[column] = pd.Categorical(values)[in_range]
 
         if conversion_rate_dkk_to_eur:
-            prices_df['SpotPriceEUR'] = prices_df['SpotPriceDKK'] * conversion_rate_dkk_to_eur
+            columns['SpotPriceEUR'] = columns['SpotPriceDKK'] * conversion_rate_dkk_to_eur
+        prices_df = pd.DataFrame(columns)
+        prices_df.attrs['resolution'] = infer_resolution(prices_df)
         return prices_df
-    except (ValueError, TypeError) as e:
+    except (ValueError, TypeError, KeyError) as e:
         logging.error(f"Error while parsing data into DataFrame: {e}")
         exit(1)
 
 
+# Return the length of one price interval, 1 hour or 15 minutes, from the smallest step between timestamps
+def infer_resolution(prices_df):
+    if 'resolution' in prices_df.attrs:
+        return prices_df.attrs['resolution']
+    column = 'HourUTC' if 'HourUTC' in prices_df else 'HourDK'
+    timestamps = np.unique(prices_df[column].to_numpy())
+    steps = np.diff(timestamps)
+    if len(steps) == 0:
+        return DEFAULT_RESOLUTION
+    return pd.Timedelta(steps.min())
+
+
+# Aggregate the prices to a coarser resolution (hourly by default) by averaging the intervals in each period
+def resample_prices(prices_df, freq='1h'):
+    freq = pd.Timedelta(freq)
+    if infer_resolution(prices_df) >= freq:
+        return prices_df
+    # Group on UTC when possible, so the repeated local hour at the end of daylight saving time stays two hours
+    period_column = 'HourUTC' if 'HourUTC' in prices_df else 'HourDK'
+    group_keys = [prices_df[period_column].dt.floor(freq).rename('Period')]
+    if 'PriceArea' in prices_df:
+        group_keys.insert(0, prices_df['PriceArea'])
+    aggregations = {column: 'mean' for column in ('SpotPriceDKK', 'SpotPriceEUR') if column in prices_df}
+    aggregations.update({column: 'first' for column in ('HourDK', 'HourUTC') if column in prices_df})
+    resampled_df = prices_df.groupby(group_keys, observed=True, sort=True).agg(aggregations)
+    resampled_df = resampled_df.reset_index(level='Period', drop=True).reset_index()
+    resampled_df = resampled_df[[column for column in prices_df.columns if column in resampled_df]]
+    resampled_df.attrs['resolution'] = freq
+    return resampled_df
+
+
+# Number of statistics results kept in memory
+STATISTICS_CACHE_SIZE = 64
+
+# Statistics results keyed by the prices version and the requested parameters, shared by the menu, exporter,
+# service and PLC writer so they all get the same values without recomputing them
+STATISTICS_CACHE = LruCache(STATISTICS_CACHE_SIZE)
+
+
+# Return a content hash of the EUR prices, the only values the daily statistics and percentiles depend on.
+# It is computed from the price array on every call, so prices changed in place or derived from other prices are
+# never served the statistics of other prices. Hashing one float64 array costs microseconds.
+def prices_version(prices):
+    return hashlib.blake2b(np.ascontiguousarray(prices).view(np.uint8), digest_size=16).hexdigest()
+
+
+# Return the cached result for the key, or compute and cache it
+def cached_statistics(key, compute):
+    result = STATISTICS_CACHE.get(key)
+    if result is None:
+        increment('statistics_cache', result='miss')
+        result = compute()
+        STATISTICS_CACHE.put(key, result)
+    else:
+        increment('statistics_cache', result='hit')
+    return result
+
+
+# Daily statistics computed from one sorted price array.
+# percentiles maps each requested quantile to its price, current_price is None when now is not in the data.
+DailyStatistics = namedtuple('DailyStatistics', ['min', 'max', 'spread', 'mean', 'current_price', 'percentiles',
+                                                 'count'])
+
+
+# Return the EUR prices as a float64 array
+def prices_eur(prices_df):
+    return prices_df['SpotPriceEUR'].to_numpy(dtype='float64')
+
+
+# Return a price array sorted, without missing values
+def sorted_prices_eur(prices):
+    return np.sort(prices[~np.isnan(prices)])
+
+
+# Linear-interpolated quantiles of an already sorted array, the same as pandas' default quantile
+def sorted_quantiles(sorted_prices, quantiles):
+    quantiles = np.asarray(quantiles, dtype='float64')
+    if np.any((quantiles < 0) | (quantiles > 1)):
+        raise ValueError("percentiles should all be in the interval [0, 1]")
+    if len(sorted_prices) == 0:
+        return np.full(quantiles.shape, np.nan)
+    positions = quantiles * (len(sorted_prices) - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, len(sorted_prices) - 1)
+    return sorted_prices[lower] + (sorted_prices[upper] - sorted_prices[lower]) * (positions - lower)
+
+
+# Look up the price of the interval (hour or quarter) containing now, matching on both date and time
+def lookup_current_price(prices_df, now=None):
+    interval_start = pd.Timestamp(now or dt.now()).floor(infer_resolution(prices_df)).to_datetime64()
+    matches = np.flatnonzero(prices_df['HourDK'].to_numpy() == interval_start)
+    return prices_df['SpotPriceEUR'].to_numpy()[matches[0]] if len(matches) else None
+
+
+# Calculate min, max, spread, mean, the current price and any number of percentiles from one sort.
+# Everything except the current price is cached per prices version and quantiles.
+@timed()
+def calculate_daily_statistics(prices_df, quantiles=(), now=None):
+    quantiles = tuple(float(quantile) for quantile in quantiles)
+    prices = prices_eur(prices_df)
+    statistics = cached_statistics(('daily_statistics', prices_version(prices), quantiles),
+                                   lambda: daily_statistics_of(sorted_prices_eur(prices), quantiles))
+    return statistics._replace(current_price=lookup_current_price(prices_df, now),
+                               percentiles=dict(statistics.percentiles))
+
+
+# Statistics of a sorted price array, without the current price
+def daily_statistics_of(sorted_prices, quantiles):
+    if len(sorted_prices) == 0:
+        return DailyStatistics(None, None, None, None, None, dict.fromkeys(quantiles), 0)
+
+    daily_min, daily_max = sorted_prices[0], sorted_prices[-1]
+    percentiles = dict(zip(quantiles, sorted_quantiles(sorted_prices, quantiles)))
+    return DailyStatistics(daily_min, daily_max, daily_max - daily_min, sorted_prices.mean(), None,
+                           percentiles, len(sorted_prices))
+
+
+# Calculate the statistics per day (and per price area, if present) of a multi-day DataFrame.
+# Returns a DataFrame indexed by day with min, max, spread, mean, count and one column per quantile.
+@timed()
+def calculate_statistics_by_day(prices_df, quantiles=()):
+    prices = prices_df['SpotPriceEUR'].to_numpy(dtype='float64')
+    days = prices_df['HourDK'].to_numpy().astype('datetime64[D]')
+    valid = ~np.isnan(prices)
+    prices, days = prices[valid], days[valid]
+    group_keys = [days]
+    if 'PriceArea' in prices_df:
+        areas = pd.Categorical(prices_df['PriceArea'])[valid]
+        group_keys.insert(0, areas.codes)
+
+    # One sort orders the prices within each group, the group boundaries come from the sorted keys
+    order = np.lexsort([prices] + group_keys[::-1])
+    prices = prices[order]
+    sorted_keys = [keys[order] for keys in group_keys]
+    is_start = np.ones(len(prices), dtype=bool)
+    is_start[1:] = np.logical_or.reduce([keys[1:] != keys[:-1] for keys in sorted_keys])
+    starts = np.flatnonzero(is_start)
+    counts = np.diff(np.append(starts, len(prices)))
+    ends = starts + counts - 1
+
+    stats = {
+        'min': prices[starts],
+        'max': prices[ends],
+        'spread': prices[ends] - prices[starts],
+        'mean': np.add.reduceat(prices, starts) / counts if len(prices) else np.empty(0),
+        'count': counts,
+    }
+    for quantile in quantiles:
+        positions = starts + float(quantile) * (counts - 1)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.minimum(lower + 1, ends)
+        stats[f'q{quantile}'] = prices[lower] + (prices[upper] - prices[lower]) * (positions - lower)
+
+    index = pd.Index(sorted_keys[-1][starts], name='Day')
+    if len(sorted_keys) == 2:
+        area_index = areas.categories[sorted_keys[0][starts]]
+        index = pd.MultiIndex.from_arrays([area_index, index], names=['PriceArea', 'Day'])
+    return pd.DataFrame(stats, index=index)
+
+
 # Calculate the percentiles and return a DataFrame
 # Modify the calculate_percentiles function to return the calculated percentiles
+# The results are cached per prices version and percentiles, each caller gets its own copy of the DataFrame.
+@timed()
 def calculate_percentiles(prices_df, x, y):
-    percentiles_df = pd.DataFrame(columns=['Percentile', 'SpotPriceEUR'])
+    prices = prices_eur(prices_df)
+    percentiles_df, x_max_percentile, y_min_percentile = cached_statistics(
+        ('percentiles', prices_version(prices), x, y), lambda: percentiles_of(prices, x, y))
+    return percentiles_df.copy(), x_max_percentile, y_min_percentile
+
+
+# Calculate the percentiles DataFrame and values from the EUR prices, without the cache
+def percentiles_of(prices, x, y):
+    rows = []
     x_max_percentile = None
     y_min_percentile = None
+    sorted_prices = sorted_prices_eur(prices)
 
     if x:
         try:
             x = float(x)
-            x_max_percentile = prices_df['SpotPriceEUR'].quantile(1 - x)
-            df_x = pd.DataFrame([{'Percentile': f'{x * 100}th Max', 'SpotPriceEUR': x_max_percentile}],
-                                columns=percentiles_df.columns)
-            percentiles_df = pd.concat([percentiles_df, df_x])
+            x_max_percentile = sorted_quantiles(sorted_prices, [1 - x])[0]
+            rows.append({'Percentile': f'{x * 100}th Max', 'SpotPriceEUR': x_max_percentile})
         except ValueError:
             logging.error("Error: Invalid input for x")
 
     if y:
         try:
             y = float(y)
-            y_min_percentile = prices_df['SpotPriceEUR'].quantile(y)
-            df_y = pd.DataFrame([{'Percentile': f'{y * 100}th Min', 'SpotPriceEUR': y_min_percentile}],
-                                columns=percentiles_df.columns)
-            percentiles_df = pd.concat([percentiles_df, df_y])
+            y_min_percentile = sorted_quantiles(sorted_prices, [y])[0]
+            rows.append({'Percentile': f'{y * 100}th Min', 'SpotPriceEUR': y_min_percentile})
         except ValueError:
             logging.error("Error: Invalid input for y")
 
+    percentiles_df = pd.DataFrame(rows, columns=['Percentile', 'SpotPriceEUR'])
     return percentiles_df, x_max_percentile, y_min_percentile
 
 
 # Calculate the price difference between the daily minimum and maximum in EUR
+@timed()
 def calculate_price_difference(prices_df):
     daily_min_eur = prices_df['SpotPriceEUR'].min()
     daily_max_eur = prices_df['SpotPriceEUR'].max()
@@ -66,24 +274,15 @@ def calculate_price_difference(prices_df):
 
 
 # Calculate the average price for the day in EUR
+@timed()
 def calculate_daily_average(prices_df):
     return prices_df['SpotPriceEUR'].mean()
 
 
-# Get the current hour and display the price for DK1, DK2, and the average of the two prices
+# Get the price for DK1 for the current hour (or quarter, for quarter-hour prices) of the current day
+@timed()
 def get_current_hour_prices(prices_df):
-    current_hour = dt.now().hour
-    # Filter based on the hour
-    current_hour_prices = prices_df[prices_df['HourDK'].dt.hour == current_hour]
-
-    # Assuming you only have one price per hour, this will get the price for DK1
-    if not current_hour_prices.empty:
-        current_hour_price_DK1_EUR = current_hour_prices['SpotPriceEUR'].values[0]
-    else:
-        current_hour_price_DK1_EUR = None  # Or handle this scenario appropriately
-
-    return current_hour_price_DK1_EUR
-
+    return lookup_current_price(prices_df)
 
 
 # Ask user if they want to sort the prices from low to high (y/n)
@@ -93,46 +292,24 @@ def sort_prices(prices_df):
         prices_df.sort_values(by=['SpotPriceEUR'], inplace=True)
 
 
-# Save the specified percentiles to a cache file
-def save_percentiles_to_cache(x, y):
+# Save the specified percentiles to the settings cache
+def save_percentiles_to_cache(x, y, cache=None):
     try:
-        with open('percentiles_cache.pkl', 'wb') as f:
-            pickle.dump((x, y), f)
-    except (PermissionError, pickle.PicklingError) as e:
+        (cache or DiskCache()).save_setting('percentiles', [x, y])
+    except (OSError, TypeError) as e:
         logging.error(f"Error while saving percentiles to cache: {e}")
 
 
 # Load the last cached percentiles and return them
-def load_cached_percentiles():
+def load_cached_percentiles(cache=None):
     try:
-        with open('percentiles_cache.pkl', 'rb') as f:
-            x_last, y_last = pickle.load(f)
-            logging.info("Successfully read from cache.")
-            return x_last, y_last
-    except FileNotFoundError:
-        logging.warning("Warning: Cache file not found. Using default values.")
-    except PermissionError:
-        logging.warning("Warning: Permission denied while accessing the cache file. Using default values.")
-    except pickle.UnpicklingError:
-        logging.error("Error while reading the cache file. Using default values.")
-    return None, None
-
-
-# Get the MAC address of the computer running the program
-def get_mac_address():
-    mac = uuid.UUID(int=uuid.getnode()).hex[-12:]
-    return ":".join([mac[e:e + 2] for e in range(0, 11, 2)])
-
-
-# Print the program logo
-def print_logo():
-    logo = """
-..######..########...#######..########....########..########..####..######..########..######.
-.##....##.##.....##.##.....##....##.......##.....##.##.....##..##..##....##.##.......##....##
-.##.......##.....##.##.....##....##.......##.....##.##.....##..##..##.......##.......##......
-..######..########..##.....##....##.......########..########...##..##.......######....######.
-.......##.##........##.....##....##.......##........##...##....##..##.......##.............##
-.##....##.##........##.....##....##.......##........##....##...##..##....##.##.......##....##
-..######..##.........#######.....##.......##........##.....##.####..######..########..######.
-"""
-    print(logo)
+        percentiles = (cache or DiskCache()).load_setting('percentiles')
+    except OSError as e:
+        logging.warning(f"Warning: Could not access the cache ({e}). Using default values.")
+        return None, None
+    if percentiles is None:
+        logging.warning("Warning: No cached percentiles found. Using default values.")
+        return None, None
+    logging.info("Successfully read from cache.")
+    x_last, y_last = percentiles
+    return x_last, y_last
@@ -1,15 +1,102 @@
-# Purpose: Module to export dataframes to Excel
+# Purpose: Module to export dataframes to Excel, CSV and Parquet
 import logging
+import os
+from datetime import date
 
-import pandas as pd
+# Formats the exporter can write. xlsx is written row by row in openpyxl's write-only mode.
+EXPORT_FORMATS = ('xlsx', 'csv', 'parquet')
+
+# Rows converted to Python values at a time when streaming a sheet into a write-only workbook
+XLSX_CHUNK_SIZE = 10000
+
+
+# Build a date-stamped export path, e.g. SpotPrices_2024-05-01.xlsx or SpotPrices_2024-05-01_Prices.csv
+def export_path(directory, name, export_date, extension, sheet_name=None):
+    suffix = f"_{sheet_name}" if sheet_name else ""
+    return os.path.join(directory, f"{name}_{export_date:%Y-%m-%d}{suffix}.{extension}")
+
+
+# Yield the rows of a DataFrame as tuples of Python values that openpyxl can write, one chunk at a time.
+# Missing values become empty cells, and timezone-aware timestamps are written in their local time.
+def iter_sheet_rows(df, chunk_size=XLSX_CHUNK_SIZE):
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        for column in chunk.columns:
+            if getattr(chunk[column].dtype, 'tz', None) is not None:
+                chunk = chunk.assign(**{column: chunk[column].dt.tz_localize(None)})
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        yield from chunk.itertuples(index=False, name=None)
+
+
+# Write the sheets {sheet_name: DataFrame} to an xlsx file in write-only mode, so memory use stays constant
+def write_xlsx(path, sheets):
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for sheet_name, df in sheets.items():
+        worksheet = workbook.create_sheet(sheet_name)
+        worksheet.append([str(column) for column in df.columns])
+        for row in iter_sheet_rows(df):
+            worksheet.append(row)
+    workbook.save(path)
+
+
+# Write the sheets to one file per format and return the written paths. CSV and Parquet get one file per sheet.
+# Files are written under a temporary name and then renamed, so a reader never sees a half-written export.
+def export_dataframes(sheets, formats=('xlsx',), directory='.', name='SpotPrices', export_date=None):
+    unknown_formats = set(formats) - set(EXPORT_FORMATS)
+    if unknown_formats:
+        raise ValueError(f"Unknown export formats {sorted(unknown_formats)}. "
+                         f"Known formats: {', '.join(EXPORT_FORMATS)}")
+    export_date = export_date or date.today()
+    os.makedirs(directory, exist_ok=True)
+
+    paths = []
+    for export_format in formats:
+        if export_format == 'xlsx':
+            targets = [(export_path(directory, name, export_date, 'xlsx'), sheets)]
+        else:
+            targets = [(export_path(directory, name, export_date, export_format, sheet_name), df)
+                       for sheet_name, df in sheets.items()]
+        for path, content in targets:
+            tmp_path = f"{path}.tmp"
+            try:
+                if export_format == 'xlsx':
+                    write_xlsx(tmp_path, content)
+                elif export_format == 'csv':
+                    content.to_csv(tmp_path, index=False)
+                else:
+                    # Parquet stores DataFrame.attrs as JSON, which cannot hold the price resolution
+                    content = content.copy(deep=False)
+                    content.attrs = {}
+                    content.to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            paths.append(path)
+    logging.info(f"Exported {', '.join(sheets)} to {', '.join(paths)}.")
+    return paths
 
 
 # Export dataframes to Excel
-def export_to_excel(prices_df, percentiles_df):
+def export_to_excel(prices_df, percentiles_df, directory='.', export_date=None):
     try:
-        with pd.ExcelWriter('SpotPrices.xlsx') as writer:
-            prices_df.to_excel(writer, sheet_name='Prices', index=False)
-            percentiles_df.to_excel(writer, sheet_name='Percentiles', index=False)
-            logging.info("Successfully exported dataframes to Excel.")
+        return export_dataframes({'Prices': prices_df, 'Percentiles': percentiles_df}, ('xlsx',), directory,
+                                 export_date=export_date)[0]
     except Exception as e:
         logging.error(f"Error while exporting dataframes to Excel: {e}")
+        return None
+
+
+# Export the day's prices, and the percentiles if given, without prompting. Used by the service for its
+# daily archive. Returns the written paths, or an empty list if the export failed.
+def export_daily_archive(prices_df, percentiles_df=None, formats=('csv',), directory='archive', export_date=None):
+    sheets = {'Prices': prices_df}
+    if percentiles_df is not None:
+        sheets['Percentiles'] = percentiles_df
+    try:
+        return export_dataframes(sheets, formats, directory, export_date=export_date)
+    except Exception as e:
+        logging.error(f"Error while exporting the daily archive: {e}")
+        return []
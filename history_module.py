@@ -0,0 +1,166 @@
+# Purpose: This module stores historical spot prices for several price areas in partitioned Parquet files.
+import json
+import logging
+import os
+from datetime import date, timedelta
+
+import pandas as pd
+
+from data_processing_module import COLUMN_ALIASES
+from streaming_module import PAGE_SIZE, fetch_price_columns
+
+# Directory the price history is stored in
+HISTORY_DIR = 'history'
+
+# Energi Data Service dataset with the historical hourly spot prices. Use DayAheadPrices for quarter-hour prices
+# from October 2025 onwards.
+PRICES_DATASET_URL = 'https://api.energidataservice.dk/dataset/Elspotprices'
+
+# Columns kept in the history, named as in Elspotprices. HourDK/HourUTC hold the interval start at any resolution.
+HISTORY_COLUMNS = ['HourUTC', 'HourDK', 'PriceArea', 'SpotPriceDKK', 'SpotPriceEUR']
+
+# Columns requested from each dataset, in the order of HISTORY_COLUMNS
+DATASET_COLUMNS = {
+    'Elspotprices': HISTORY_COLUMNS,
+    'DayAheadPrices': ['TimeUTC', 'TimeDK', 'PriceArea', 'DayAheadPriceDKK', 'DayAheadPriceEUR'],
+}
+
+# Default price areas
+PRICE_AREAS = ['DK1', 'DK2']
+
+
+# Group a sorted list of dates into (start, end) ranges of consecutive days, with end exclusive
+def group_date_ranges(days):
+    ranges = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + timedelta(days=1)
+        else:
+            ranges.append([day, day + timedelta(days=1)])
+    return [(start, end) for start, end in ranges]
+
+
+# Return the first day of every month that overlaps the range [start, end)
+def months_in_range(start, end):
+    month = date(start.year, start.month, 1)
+    while month < end:
+        yield month
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+# Give a DataFrame the history columns and dtypes
+def conform_frame(prices_df):
+    prices_df = prices_df.reindex(columns=HISTORY_COLUMNS)
+    for column in ('HourUTC', 'HourDK'):
+        prices_df[column] = pd.to_datetime(prices_df[column], format='%Y-%m-%dT%H:%M:%S').astype('datetime64[us]')
+    prices_df['PriceArea'] = prices_df['PriceArea'].astype('category')
+    prices_df['SpotPriceDKK'] = prices_df['SpotPriceDKK'].astype('float64')
+    prices_df['SpotPriceEUR'] = prices_df['SpotPriceEUR'].astype('float64')
+    return prices_df
+
+
+# Convert API records into a typed DataFrame with the history columns
+def records_to_frame(records):
+    return conform_frame(pd.DataFrame.from_records(records).rename(columns=COLUMN_ALIASES))
+
+
+# Historical price store partitioned by price area and month: {directory}/PriceArea=DK1/month=2024-01.parquet
+class PriceHistoryStore:
+    def __init__(self, directory=HISTORY_DIR, dataset_url=PRICES_DATASET_URL, client=None, page_size=PAGE_SIZE):
+        self.directory = directory
+        self.dataset_url = dataset_url
+        self.client = client
+        self.page_size = page_size
+
+    # Columns of the configured dataset, in the order of HISTORY_COLUMNS
+    @property
+    def dataset_columns(self):
+        return DATASET_COLUMNS.get(self.dataset_url.rstrip('/').rsplit('/', 1)[-1], HISTORY_COLUMNS)
+
+    def _partition_path(self, area, month):
+        return os.path.join(self.directory, f"PriceArea={area}", f"month={month:%Y-%m}.parquet")
+
+    def _read_partition(self, area, month, columns=None):
+        path = self._partition_path(area, month)
+        if not os.path.exists(path):
+            return None
+        return pd.read_parquet(path, columns=columns)
+
+    # Return the set of days already stored for an area in the range [start, end)
+    def stored_days(self, area, start, end):
+        days = set()
+        for month in months_in_range(start, end):
+            partition = self._read_partition(area, month, columns=['HourDK'])
+            if partition is not None:
+                days.update(partition['HourDK'].dt.date.unique())
+        return {day for day in days if start <= day < end}
+
+    # Return the days missing for each area in the range [start, end)
+    def missing_days(self, areas, start, end):
+        all_days = {start + timedelta(days=offset) for offset in range((end - start).days)}
+        return {area: sorted(all_days - self.stored_days(area, start, end)) for area in areas}
+
+    # Fetch prices for the areas in [start, end) from the API, streamed page by page into column buffers
+    def fetch(self, areas, start, end):
+        params = {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'filter': json.dumps({'PriceArea': list(areas)}),
+            'columns': ','.join(self.dataset_columns),
+            'sort': f'{self.dataset_columns[0]} ASC',
+        }
+        return conform_frame(fetch_price_columns(self.dataset_url, params, self.client, self.page_size))
+
+    # Fetch and store only the days that are missing. Returns the number of rows added.
+    def update(self, start, end, areas=PRICE_AREAS):
+        missing = self.missing_days(areas, start, end)
+        missing_any = set().union(*missing.values())
+        if not missing_any:
+            logging.info(f"Price history for {list(areas)} from {start} to {end} is complete.")
+            return 0
+
+        rows_added = 0
+        for range_start, range_end in group_date_ranges(missing_any):
+            range_areas = [area for area in areas if any(range_start <= day < range_end for day in missing[area])]
+            fetched_df = self.fetch(range_areas, range_start, range_end)
+            # Only keep the days that were actually missing, the others are stored already
+            fetched_days = fetched_df['HourDK'].dt.date
+            keep = pd.Series(False, index=fetched_df.index)
+            for area in range_areas:
+                keep |= (fetched_df['PriceArea'] == area) & fetched_days.isin(set(missing[area]))
+            rows_added += self.append(fetched_df[keep])
+            logging.info(f"Fetched price history for {range_areas} from {range_start} to {range_end}.")
+        return rows_added
+
+    # Merge rows into the monthly partitions. Returns the number of rows written.
+    def append(self, prices_df):
+        if prices_df.empty:
+            return 0
+        months = prices_df['HourDK'].dt.to_period('M')
+        for (area, month), group in prices_df.groupby([prices_df['PriceArea'].astype(str), months], observed=True):
+            month_start = month.to_timestamp().date()
+            existing = self._read_partition(area, month_start)
+            if existing is not None:
+                group = pd.concat([existing, group], ignore_index=True)
+            group = group.drop_duplicates(subset='HourUTC', keep='last').sort_values('HourUTC')
+            group['PriceArea'] = group['PriceArea'].astype('category')
+            path = self._partition_path(area, month_start)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            group.to_parquet(path, index=False)
+        return len(prices_df)
+
+    # Return the stored prices for [start, end) and the given areas as one DataFrame
+    def query(self, start, end, areas=PRICE_AREAS):
+        frames = []
+        for area in areas:
+            for month in months_in_range(start, end):
+                partition = self._read_partition(area, month)
+                if partition is not None:
+                    frames.append(partition)
+        if not frames:
+            return records_to_frame([])
+        prices_df = pd.concat(frames, ignore_index=True)
+        start_ts, end_ts = pd.Timestamp(start), pd.Timestamp(end)
+        prices_df = prices_df[(prices_df['HourDK'] >= start_ts) & (prices_df['HourDK'] < end_ts)]
+        prices_df['PriceArea'] = prices_df['PriceArea'].astype('category')
+        return prices_df.sort_values(['PriceArea', 'HourUTC'], ignore_index=True)
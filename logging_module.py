@@ -1,10 +1,82 @@
 # Purpose: Setup logging for the application
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import queue
+from datetime import datetime
 
+# Attributes every log record has. Anything else on a record was passed with extra= and is logged as a field.
+STANDARD_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
 
-# Setup logging to file app.log
-def setup_logging():
-    logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# The queue handler on the root logger and the listener writing its records to the log file, once logging is setup
+_queue_handler = None
+_listener = None
 
 
-setup_logging()
+# Format log records as one JSON object per line, including the fields passed with extra=
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in STANDARD_RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Queue handler that resolves the message in the calling thread, but leaves the formatting to the listener.
+# The traceback of an exception is passed on as text, in the exception field for the JSON format and in exc_text
+# for the text format, so no frames are kept alive.
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_text = None
+        if record.exc_info:
+            record.exception = record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+# Setup logging to file app.log. Records are put on a queue and written by a background thread, so slow log I/O
+# never stalls the caller. Calling it again does nothing.
+def setup_logging(filename='app.log', level=logging.INFO, json_format=True):
+    global _queue_handler, _listener
+    if _listener is not None:
+        return _listener
+
+    file_handler = logging.FileHandler(filename)
+    if json_format:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    _queue_handler = QueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    # Flush the queued records when the program exits
+    atexit.register(stop_logging)
+    return _listener
+
+
+# Stop the queue listener after it has written the queued records
+def stop_logging():
+    global _queue_handler, _listener
+    if _listener is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _queue_handler = None
+        _listener = None
@@ -1,70 +1,68 @@
 # Import required modules
-from api_module import *
+import atexit
+import logging
+import sys
+from datetime import datetime as dt
+
 from config_module import *
-from data_processing_module import *
-from excel_module import *
 from logging_module import setup_logging
-from plc_module import *
-
-# ---------------------------------- Init ------------------------------------------------------
-
-# Initializing variables
-current_hour_price_DK1_EUR = None
-current_hour_price_DK2_EUR = None
-x_max_percentile = None
-y_min_percentile = None
-price_diff_eur = None
-avg_price_eur = None
-plc_connected = False
-data_to_write = None
-client = None
-prices_df = None
-MOXA_PORT = 502
-
-# Setup logging
-setup_logging()
 
-# Validate MAC address
-current_id = get_mac_address()
-if current_id not in AUTHORIZED_IDS:
-    logging.warning(f"Unauthorized access attempt by MAC address: {current_id}")
-    print("Apologies. You are not currently authorized to run this program.")
-    exit(1)
-logging.info(f"Authorized access by MAC address: {current_id}")
-
-# Fetch the exchange rate if the API key is valid
-if validate_exchange_rate_api_key(api_key, exchange_rate_api_url):
-    conversion_rate_dkk_to_eur = fetch_exchange_rate(api_key, exchange_rate_api_url)
-else:
-    logging.error("Exiting due to invalid API key.")
-    exit(1)
+# pandas, requests and the data processing are imported when the prices are first needed by a menu option, pymodbus
+# only when the PLC option runs and the Excel writer only on export, so the menu is not held up by modules it may
+# never use.
 
-# ---------------------------------- Fetch Data -----------------------------------------------------
 
-data, status_code = fetch_electricity_prices(electricity_prices_api_url)
+# ---------------------------------- Init ------------------------------------------------------
 
-# If response is OK, continue
-if data:
-    prices_df = process_data(data, conversion_rate_dkk_to_eur)
+# Validate MAC address
+def check_authorized():
+    from auth_module import get_mac_address
 
-    # Get the current hour and the price for DK1, DK2 as well as the average of the two prices
-    current_hour_price_DK1_EUR = get_current_hour_prices(prices_df)
+    current_id = get_mac_address()
+    if current_id not in AUTHORIZED_IDS:
+        logging.warning(f"Unauthorized access attempt by MAC address: {current_id}")
+        print("Apologies. You are not currently authorized to run this program.")
+        exit(1)
+    logging.info(f"Authorized access by MAC address: {current_id}")
 
 
-    # Calculate price difference between daily minimum and maximum in EUR
-    price_diff_eur = calculate_price_difference(prices_df)
+# ---------------------------------- Fetch Data -----------------------------------------------------
 
-    # Calculate the average price for the day in EUR
-    avg_price_eur = calculate_daily_average(prices_df)
+# Fetch today's prices and return the prices DataFrame and its daily statistics, or (None, None) without data
+def load_prices(response_cache):
+    from api_module import HttpClient, fetch_startup_data
+    from data_processing_module import calculate_daily_statistics, process_data
+
+    # Shared HTTP client with connection pooling, timeouts and retries
+    http_client = HttpClient(connect_timeout=connect_timeout, read_timeout=timeout, max_retries=max_retries)
+
+    # Fetch the exchange rate and the prices concurrently, the exchange rate response also validates the API key
+    api_key_valid, conversion_rate_dkk_to_eur, data, status_code = fetch_startup_data(
+        api_key, exchange_rate_api_url, electricity_prices_api_url, cache=response_cache, client=http_client)
+    if api_key_valid is False:
+        logging.error("Exiting due to invalid API key.")
+        exit(1)
+    if not conversion_rate_dkk_to_eur:
+        logging.error("Exiting as the exchange rate could not be fetched and none is cached.")
+        print("The exchange rate could not be fetched. Please try again later.")
+        exit(1)
+
+    # If response is OK, continue
+    if not data:
+        return None, None
+    prices_df = process_data(data, conversion_rate_dkk_to_eur)
 
-    # Load the last cached percentiles
-    x_last, y_last = load_cached_percentiles()
+    # Calculate the current hour price for DK1, the spread between the daily minimum and maximum and the daily
+    # average in EUR, all from one pass over the sorted prices
+    return prices_df, calculate_daily_statistics(prices_df)
 
 
 # ---------------------------------- Init Methods ------------------------------------------------
-def percentile():
+def percentile(prices_df, response_cache):
+    from data_processing_module import calculate_percentiles, load_cached_percentiles, save_percentiles_to_cache
+
     # Load the last cached percentiles
-    x_last, y_last = load_cached_percentiles()
+    x_last, y_last = load_cached_percentiles(response_cache)
 
     # Get percentiles from user or cache
     x = input(f"Enter the xth maximum percentile (e.g., 0.66 for 66%), or press ENTER to use last value ({x_last}): ")
@@ -76,8 +74,9 @@ def percentile():
     if not y:
         y = y_last
 
-    # Save the specified percentiles to a cache file
-    save_percentiles_to_cache(x, y)
+    # Save the specified percentiles to the settings cache, if they changed
+    if (x, y) != (x_last, y_last):
+        save_percentiles_to_cache(x, y, response_cache)
 
     percentiles_df, x_max_percentile, y_min_percentile = calculate_percentiles(prices_df, x, y)
 
@@ -86,91 +85,100 @@ def percentile():
     return percentiles_df, x_max_percentile, y_min_percentile
 
 
-def info():
+# Print the program logo
+def print_logo():
+    logo = """
+..######..########...#######..########....########..########..####..######..########..######.
+.##....##.##.....##.##.....##....##.......##.....##.##.....##..##..##....##.##.......##....##
+.##.......##.....##.##.....##....##.......##.....##.##.....##..##..##.......##.......##......
+..######..########..##.....##....##.......########..########...##..##.......######....######.
+.......##.##........##.....##....##.......##........##...##....##..##.......##.............##
+.##....##.##........##.....##....##.......##........##....##...##..##....##.##.......##....##
+..######..##.........#######.....##.......##........##.....##.####..######..########..######.
+"""
+    print(logo)
+
+
+def info(daily_statistics):
     print("\n*** CURRENT HOUR PRICE POINT ***")
-    if current_hour_price_DK1_EUR is not None:
-        print(f'The price for the current hour ({dt.now().hour}) is {current_hour_price_DK1_EUR:.2f} EUR/MWh for DK1\n')
+    if daily_statistics.current_price is not None:
+        print(f'The price for the current hour ({dt.now().hour}) is {daily_statistics.current_price:.2f} '
+              f'EUR/MWh for DK1\n')
     else:
         print("Current hour price for DK1 is not available.")
 
     print("*** SPOT PRICE DIFFERENCE ***")
-    print(f'The price difference between the daily minimum and maximum is {price_diff_eur:.2f} EUR/MWh\n')
+    print(f'The price difference between the daily minimum and maximum is {daily_statistics.spread:.2f} EUR/MWh\n')
 
     print("*** DAILY PRICE AVERAGE ***")
-    print(f'The average price for the day is {avg_price_eur:.2f} EUR/MWh\n')
+    print(f'The average price for the day is {daily_statistics.mean:.2f} EUR/MWh\n')
+
 
+def handle_plc_option(daily_statistics, x_max_percentile, y_min_percentile):
+    from plc_module import (PLC_CONNECT_ATTEMPTS, build_plc_signals, map_signals_to_registers,
+                            plc_targets_from_config, write_signals_to_targets)
 
-def handle_plc_option():
     plc_connected = False
 
     connect_to_plc = input("Do you want to connect to the PLC? (y/n): ").strip().lower()
+    if connect_to_plc != 'y':
+        return plc_connected
+
+    targets = plc_targets_from_config(plc_targets, plc_host, plc_port, unit_id, scaling_factor)
+    signals = build_plc_signals(daily_statistics.spread, daily_statistics.mean, daily_statistics.current_price,
+                                y_min_percentile, x_max_percentile)
+
+    print("\n*** Register Data Preview ***")
+    for target in targets:
+        print(f"PLC {target.name} ({target.host}:{target.port})")
+        for address, value in map_signals_to_registers(signals, target.register_map).items():
+            print(f"Register Address: {address}, Data to be written: {value}")
+
+    write_to_registers = input("Do you want to write the data to the registers? (y/n): ").strip().lower()
+    if write_to_registers != 'y':
+        return plc_connected
+
+    # Write to all targets at once. Retry the failed ones on request, but at most PLC_CONNECT_ATTEMPTS times.
+    pending = targets
+    for attempt in range(1, PLC_CONNECT_ATTEMPTS + 1):
+        results = write_signals_to_targets(pending, signals, plc_max_concurrency, timeout=plc_timeout,
+                                           reconnect_attempts=1)
+        for name, written in results.items():
+            print(f"PLC {name}: {'wrote registers' if written else 'FAILED'}")
+        plc_connected = plc_connected or any(results.values())
+        pending = [target for target in pending if not results[target.name]]
+        if not pending:
+            logging.info("Successfully wrote to registers.")
+            break
 
-    if connect_to_plc == 'y':
-        client = setup_plc_client(IP_ADDRESS=MOXA_IP_ADDRESS, PORT=MOXA_PORT)
-
-        # Check if the client has been successfully created
-        if client is not None:
-            try:
-                if client.connect():
-                    plc_connected = True
-                    logging.info("Successfully connected to the PLC.")
-
-                    data_to_write = {
-                        0: round(price_diff_eur, 2),
-                        1: round(avg_price_eur, 2),
-                        2: round(current_hour_price_DK1_EUR, 2),
-                        3: round(y_min_percentile, 2),
-                        4: round(x_max_percentile, 2)
-                    }
-
-                    print("\n*** Register Data Preview ***")
-                    for address, value in data_to_write.items():
-                        print(f"Register Address: {address}, Data to be written: {value}")
-
-                    write_to_registers = input("Do you want to write the data to the registers? (y/n): ").strip().lower()
-                    if write_to_registers == 'y':
-                        for address, value in data_to_write.items():
-                            write_data_to_plc(client, address, value, scaling_factor, unit_id)
-                    print("Successfully wrote to registers.")
-                    logging.info("Successfully wrote to registers.")
-
-                else:
-                    logging.error("Failed to connect to the PLC.")
-                    raise Exception("Failed to connect to the PLC.")
-
-            except Exception as e:
-                logging.error(f"An error occurred: {e}")
-                retry = input("An error occurred. Do you want to retry? (y/n): ").strip().lower()
-                if retry.lower() == 'y':
-                    handle_plc_option()  # Attempt to reconnect
-                else:
-                    print("Exiting PLC connection attempt.")
-                    logging.info("Exiting PLC connection attempt.")
-
-            finally:
-                if client:  # Close the client if it's open
-                    client.close()
-                    logging.info("PLC connection closed.")
-
-        else:
-            logging.error("PLC client could not be set up.")
-            print("PLC client setup failed.")
+        logging.error(f"Failed to write to PLC targets {[target.name for target in pending]}.")
+        if attempt == PLC_CONNECT_ATTEMPTS:
+            print(f"Giving up after {attempt} attempts.")
+            logging.info(f"Exiting PLC connection attempt after {attempt} attempts.")
+            break
+        retry = input("An error occurred. Do you want to retry the failed PLCs? (y/n): ").strip().lower()
+        if retry != 'y':
+            print("Exiting PLC connection attempt.")
+            logging.info("Exiting PLC connection attempt.")
+            break
 
     return plc_connected
 
 
 def handle_excel_option(prices_df, percentiles_df):
+    from data_processing_module import sort_prices
+    from excel_module import export_to_excel
+
     # Ask user if they want to sort the prices
     sort_prices(prices_df)
-    print("\nExporting to xlsx.")
-    time.sleep(1)
-    print("Exporting to xlsx..")
-    time.sleep(1)
-    print("Exporting to xlsx...")
+    print("\nExporting to xlsx...")
 
-    # Export dataframes to excel
-    export_to_excel(prices_df, percentiles_df)
-    print("Successfully exported data!")
+    # Export dataframes to a date-stamped workbook
+    path = export_to_excel(prices_df, percentiles_df)
+    if path:
+        print(f"Successfully exported data to {path}!")
+    else:
+        print("Export failed, see app.log for details.")
 
 
 def exit_program():
@@ -182,53 +190,85 @@ def exit_program():
 # ---------------------------------- Main program flow -------------------------------------------
 
 
-while True:
-    # Print the logo
-    print_logo()
-    print("\n           This program is the intellectual property of Alexander Flor Glering "
-          "\n                                 All Rights Reserved.")
-
-    print("\n*** Main Menu ***")
-    print("1. See current prices (i)")
-    print("2. Connect to PLC (p)")
-    print("3. Save to Excel (x)")
-    print("4. Quit (q)")
-
-    user_choice = input("\nPlease enter your choice: ").lower()
-    logging.info("Prompting user choice.")
-
-    if user_choice == 'p':
-        print("\nBefore continuing please enter the desired upper and lower percentile of the data\n")
-        percentiles_df, x_max_percentile, y_min_percentile = percentile()
-        plc_connected = handle_plc_option()
-        logging.info("User chose to initiate plc connection.")
-
-    elif user_choice == 'i':
-        info()
-        logging.info("User chose to see daily info.")
-
-    elif user_choice == 'x':
-        print("\nBefore continuing please enter the desired upper and lower percentile of the data\n")
-        percentiles_df, x_max_percentile, y_min_percentile = percentile()
-        handle_excel_option(prices_df, percentiles_df)
-        logging.info("User chose to print to Excel.")
-
-    elif user_choice == 'q':
-        confirm_exit = input("Are you sure you want to exit? (y/n): ").lower()
-        if confirm_exit == 'y':
-            logging.info("Exiting program.")
-            print("Goodbye!")
-            break
+def main():
+    # Setup logging, written as JSON lines by a background thread
+    setup_logging(json_format=log_format == 'json')
+
+    # Write the timings and error counts on exit, the service also writes them after every update
+    if metrics_file:
+        from metrics_module import write_metrics_file
+        atexit.register(write_metrics_file, metrics_file)
+    check_authorized()
+
+    # Run headless when started with --service, keeping the PLC registers updated every hour
+    if '--service' in sys.argv:
+        from service_module import run_service
+        run_service()
+        exit(0)
+
+    # Open the response cache, so restarts reuse today's prices and exchange rate
+    from cache_module import DiskCache
+    response_cache = DiskCache()
+    response_cache.prune()
+
+    # The prices are fetched when the first option that needs them is chosen, so the menu shows right away
+    prices = None
+
+    while True:
+        # Print the logo
+        print_logo()
+        print("\n           This program is the intellectual property of Alexander Flor Glering "
+              "\n                                 All Rights Reserved.")
+
+        print("\n*** Main Menu ***")
+        print("1. See current prices (i)")
+        print("2. Connect to PLC (p)")
+        print("3. Save to Excel (x)")
+        print("4. Quit (q)")
+
+        user_choice = input("\nPlease enter your choice: ").lower()
+        logging.info("Prompting user choice.")
+
+        if user_choice in ('p', 'i', 'x') and prices is None:
+            prices = load_prices(response_cache)
+            prices_df, daily_statistics = prices
+
+        if user_choice == 'p':
+            print("\nBefore continuing please enter the desired upper and lower percentile of the data\n")
+            percentiles_df, x_max_percentile, y_min_percentile = percentile(prices_df, response_cache)
+            handle_plc_option(daily_statistics, x_max_percentile, y_min_percentile)
+            logging.info("User chose to initiate plc connection.")
+
+        elif user_choice == 'i':
+            info(daily_statistics)
+            logging.info("User chose to see daily info.")
+
+        elif user_choice == 'x':
+            print("\nBefore continuing please enter the desired upper and lower percentile of the data\n")
+            percentiles_df, x_max_percentile, y_min_percentile = percentile(prices_df, response_cache)
+            handle_excel_option(prices_df, percentiles_df)
+            logging.info("User chose to print to Excel.")
+
+        elif user_choice == 'q':
+            confirm_exit = input("Are you sure you want to exit? (y/n): ").lower()
+            if confirm_exit == 'y':
+                logging.info("Exiting program.")
+                print("Goodbye!")
+                break
+            else:
+                continue  # Return to the main menu if the user decides not to exit
+
         else:
-            continue  # Return to the main menu if the user decides not to exit
+            print("Invalid option. Please enter 'p', 'x', or 'q'.")
+            continue  # Return to the main menu to prompt the user again
 
-    else:
-        print("Invalid option. Please enter 'p', 'x', or 'q'.")
-        continue  # Return to the main menu to prompt the user again
-
-    # After each process, ask the user if they want to return to the main menu or exit
-    after_process_choice = input("\nDo you want to return to the main menu (m) or quit (q)? ").lower()
-    if after_process_choice == 'q':
-        print("Goodbye!")
-        logging.info("Exiting program.")
-        break  # Exit the program
+        # After each process, ask the user if they want to return to the main menu or exit
+        after_process_choice = input("\nDo you want to return to the main menu (m) or quit (q)? ").lower()
+        if after_process_choice == 'q':
+            print("Goodbye!")
+            logging.info("Exiting program.")
+            break  # Exit the program
+
+
+if __name__ == '__main__':
+    main()
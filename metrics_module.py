@@ -0,0 +1,157 @@
+# Purpose: Timing spans and counters for the hot paths, exported in the Prometheus text format.
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Prefix of every exported metric name
+METRIC_PREFIX = 'spotprices'
+
+# Upper bounds in seconds of the span duration histogram buckets
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+
+# Thread-safe store of counters and span duration histograms, keyed by name and labels
+class MetricsRegistry:
+    def __init__(self, buckets=SPAN_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # Record one span duration: a count per bucket, plus the total count and sum as in a Prometheus histogram
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            bucket_counts, count, total = self.spans.get(key, ([0] * len(self.buckets), 0, 0.0))
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    bucket_counts[index] += 1
+            self.spans[key] = (bucket_counts, count + 1, total + seconds)
+
+    def counter_value(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.spans.clear()
+
+    # Render all metrics in the Prometheus text exposition format
+    def render_prometheus(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            spans = sorted((key, (list(buckets), count, total)) for key, (buckets, count, total) in self.spans.items())
+        lines = []
+        for name in sorted({name for (name, _), _ in counters}):
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f"{metric}{format_labels(labels)} {value}"
+                         for (counter_name, labels), value in counters if counter_name == name)
+        if spans:
+            metric = f"{METRIC_PREFIX}_span_duration_seconds"
+            lines.append(f"# HELP {metric} Duration of the instrumented operations.")
+            lines.append(f"# TYPE {metric} histogram")
+            for (name, labels), (bucket_counts, count, total) in spans:
+                span_labels = (('span', name),) + labels
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f"{metric}_bucket{format_labels(span_labels + (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{metric}_bucket{format_labels(span_labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{metric}_sum{format_labels(span_labels)} {total:.6f}")
+                lines.append(f"{metric}_count{format_labels(span_labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+# Format labels as {name="value",...}, escaping the values as the text format requires
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+# The registry the application records into
+METRICS = MetricsRegistry()
+
+
+# Count an event, e.g. increment('http_retries', reason='status')
+def increment(name, amount=1, **labels):
+    METRICS.increment(name, amount, **labels)
+
+
+# Time the enclosed block and record it as a span. The duration is also logged at debug level.
+@contextmanager
+def span(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        METRICS.observe(name, seconds, **labels)
+        # Spans run on every request, so the debug record is only built when debug logging is on
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s took %.2f ms", name, seconds * 1000, extra={'span': name, 'duration_ms': seconds * 1000})
+
+
+# Decorator recording each call of a function or coroutine function as a span, named after the function by default
+def timed(name=None):
+    def decorator(function):
+        span_name = name or function.__name__
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Write the metrics to a file, e.g. for the node_exporter textfile collector. The file is replaced atomically.
+def write_metrics_file(path, registry=METRICS):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(registry.render_prometheus())
+    os.replace(tmp_path, path)
+
+
+# Serve the metrics at http://host:port/metrics from a daemon thread and return the server
+def start_metrics_server(port, host='127.0.0.1', registry=METRICS):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
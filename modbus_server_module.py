@@ -0,0 +1,121 @@
+# Purpose: Read-only Modbus TCP server that serves the current price signals and the day's prices to SCADA/HMI
+# clients, so any number of them can poll the values without triggering API calls or PLC writes.
+import asyncio
+import logging
+import math
+
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext, ModbusSlaveContext
+from pymodbus.server import ModbusTcpServer
+
+from plc_module import DEFAULT_REGISTER_MAP, PLC_SIGNALS, scale_register_value
+
+# Register layout, the same for holding registers (function code 3) and input registers (function code 4).
+# The price signals are at the PLC register addresses 0-4, followed by the day's price slots.
+SLOT_COUNT_ADDRESS = 5        # number of price slots today: 24 hourly or 96 quarter-hour, other counts on DST days
+RESOLUTION_ADDRESS = 6        # length of a price slot in minutes
+SEQUENCE_ADDRESS = 7          # incremented on every update, so pollers can tell when new values are served
+PRICE_SLOTS_ADDRESS = 8       # the day's prices, first slot first, as one contiguous block
+
+# Room for 100 quarter-hour slots on the day daylight saving time ends. A block read may be up to 125 registers.
+MAX_PRICE_SLOTS = 100
+REGISTER_COUNT = PRICE_SLOTS_ADDRESS + MAX_PRICE_SLOTS
+
+# Register value of a signal or price that is not known, e.g. a slot without a published price
+NO_VALUE = 0x8000
+
+# Function codes that write: coils, registers, mask write and read/write multiple registers
+WRITE_FUNCTION_CODES = (5, 6, 15, 16, 22, 23)
+
+
+# Slave context that rejects all writes, so clients can never change the served values.
+# A write request is answered with an illegal data address exception.
+class ReadOnlySlaveContext(ModbusSlaveContext):
+    def validate(self, fc_as_hex, address, count=1):
+        if fc_as_hex in WRITE_FUNCTION_CODES:
+            return False
+        return super().validate(fc_as_hex, address, count)
+
+
+# Scale a value to a register value, or NO_VALUE when it is missing
+def scale_or_no_value(value, scaling_factor):
+    if value is None or math.isnan(value):
+        return NO_VALUE
+    return scale_register_value(value, scaling_factor)
+
+
+# Build the values of all registers from the price signals, the day's prices and their resolution in minutes
+def build_server_registers(signals, prices, resolution_minutes, scaling_factor=100, sequence=0):
+    if len(prices) > MAX_PRICE_SLOTS:
+        raise ValueError(f"At most {MAX_PRICE_SLOTS} price slots can be served, got {len(prices)}.")
+    registers = [0] * REGISTER_COUNT
+    for name in PLC_SIGNALS:
+        registers[DEFAULT_REGISTER_MAP[name]] = scale_or_no_value(signals.get(name), scaling_factor)
+    registers[SLOT_COUNT_ADDRESS] = len(prices)
+    registers[RESOLUTION_ADDRESS] = int(resolution_minutes)
+    registers[SEQUENCE_ADDRESS] = sequence & 0xFFFF
+    registers[PRICE_SLOTS_ADDRESS:PRICE_SLOTS_ADDRESS + len(prices)] = [
+        scale_or_no_value(float(price), scaling_factor) for price in prices]
+    registers[PRICE_SLOTS_ADDRESS + len(prices):] = [NO_VALUE] * (MAX_PRICE_SLOTS - len(prices))
+    return registers
+
+
+# Embedded Modbus TCP server for the price registers. The registers live in one in-memory block that is replaced
+# as a whole on the server's event loop, so a block read never sees half of an update.
+class PriceRegisterServer:
+    def __init__(self, host='127.0.0.1', port=5020, scaling_factor=100):
+        self.host = host
+        self.port = port
+        self.scaling_factor = scaling_factor
+        self.sequence = 0
+        # Until the first update, no signals and no price slots are served
+        self.block = ModbusSequentialDataBlock(0, build_server_registers({}, [], 0))
+        # The same block serves the holding and input registers, and any unit id
+        self.context = ModbusServerContext(slaves=ReadOnlySlaveContext(hr=self.block, ir=self.block, zero_mode=True),
+                                           single=True)
+        self.server = None
+        self.loop = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    # Start listening. Raises OSError if the address cannot be bound.
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = ModbusTcpServer(self.context, address=(self.host, self.port))
+        if not await self.server.listen():
+            self.server = None
+            raise OSError(f"Could not start the Modbus server on {self.host}:{self.port}.")
+        # With port 0 the operating system picks a free port
+        self.port = self.server.transport.sockets[0].getsockname()[1]
+        logging.info(f"Serving the price registers over Modbus TCP at {self.host}:{self.port}.")
+
+    async def stop(self):
+        if self.server is not None:
+            await self.server.shutdown()
+            self.server = None
+            logging.info("Stopped the Modbus server.")
+
+    # Serve new price signals and day prices. Can be called from any thread: the registers are replaced on the
+    # server's event loop, between two requests.
+    def update(self, signals, prices, resolution_minutes):
+        self.sequence += 1
+        registers = build_server_registers(signals, prices, resolution_minutes, self.scaling_factor, self.sequence)
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self.loop is None or running_loop is self.loop:
+            self._set_registers(registers)
+        else:
+            self.loop.call_soon_threadsafe(self._set_registers, registers)
+
+    def _set_registers(self, registers):
+        self.block.values = registers
+
+    # Return the values currently served
+    def registers(self):
+        return list(self.block.values)
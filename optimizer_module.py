@@ -0,0 +1,120 @@
+# Purpose: This module finds the cheapest hours to run a load, for scheduling the PLC.
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from price_index_module import PriceIndex, cheapest_contiguous_slots
+
+# An on/off schedule: local start time and slot length of the mask, the mask itself and the total and average price
+Schedule = namedtuple('Schedule', ['start', 'resolution', 'mask', 'total_price', 'average_price'])
+
+
+# Choose the n cheapest slots, with no constraints on how they are grouped
+def cheapest_slots(prices, n_slots):
+    costs = np.where(np.isnan(prices), np.inf, prices)
+    if n_slots > np.count_nonzero(np.isfinite(costs)):
+        return None
+    mask = np.zeros(len(prices), dtype=bool)
+    if n_slots > 0:
+        mask[np.argpartition(costs, n_slots - 1)[:n_slots]] = True
+    return mask
+
+
+# Choose n_slots slots in runs of at least min_run slots, starting at most max_starts runs, at the lowest total price.
+# Dynamic programming over (slot, starts used, run state), vectorized over the number of slots switched on.
+# Run state 0 is off, 1..min_run-1 is on in a run that must continue and min_run is on in a run that may stop.
+def constrained_slots(prices, n_slots, min_run=1, max_starts=None):
+    costs = np.where(np.isnan(prices), np.inf, prices)
+    n_total = len(costs)
+    run = max(1, min_run)
+    max_starts = n_slots // run if max_starts is None else min(max_starts, n_slots // run)
+    if n_slots == 0:
+        return np.zeros(n_total, dtype=bool)
+    if max_starts == 0:
+        return None
+
+    cost = np.full((max_starts + 1, run + 1, n_slots + 1), np.inf)
+    cost[0, 0, 0] = 0.0
+    # Per slot, which of the two possible predecessors was cheaper, for the backtracking
+    came_from_run_end = np.zeros((n_total, max_starts + 1, n_slots + 1), dtype=bool)
+    continued_run = np.zeros((n_total, max_starts + 1, n_slots + 1), dtype=bool)
+
+    for slot, price in enumerate(costs):
+        new = np.full_like(cost, np.inf)
+        # Off: stay off, or stop a run that is long enough
+        came_from_run_end[slot] = cost[:, run, :] < cost[:, 0, :]
+        new[:, 0, :] = np.minimum(cost[:, 0, :], cost[:, run, :])
+        # Start a new run
+        new[1:, 1, 1:] = cost[:-1, 0, :-1] + price
+        # Runs that are still too short must continue
+        for state in range(2, run + 1):
+            new[:, state, 1:] = cost[:, state - 1, :-1] + price
+        # A run that is long enough may also continue
+        extended = cost[:, run, :-1] + price
+        continued_run[slot, :, 1:] = extended < new[:, run, 1:]
+        new[:, run, 1:] = np.minimum(new[:, run, 1:], extended)
+        cost = new
+
+    final = np.minimum(cost[:, 0, n_slots], cost[:, run, n_slots])
+    starts = int(np.argmin(final))
+    if np.isinf(final[starts]):
+        return None
+
+    # Walk back through the recorded choices to recover the mask
+    mask = np.zeros(n_total, dtype=bool)
+    state = 0 if cost[starts, 0, n_slots] <= cost[starts, run, n_slots] else run
+    count = n_slots
+    for slot in range(n_total - 1, -1, -1):
+        if state == 0:
+            if came_from_run_end[slot, starts, count]:
+                state = run
+            continue
+        mask[slot] = True
+        count -= 1
+        if state == run and continued_run[slot, starts, count + 1]:
+            continue
+        if state == 1:
+            starts -= 1
+            state = 0
+        else:
+            state -= 1
+    return mask
+
+
+# Choose the on/off mask for n_slots slots: one contiguous run, or runs of at least min_run slots with at most
+# max_starts starts. Returns None if the load does not fit.
+def optimize_slots(prices, n_slots, contiguous=False, min_run=1, max_starts=None):
+    prices = np.asarray(prices, dtype='float64')
+    if contiguous:
+        best = cheapest_contiguous_slots(prices, n_slots)
+        if best is None:
+            return None
+        mask = np.zeros(len(prices), dtype=bool)
+        mask[best[0]:best[0] + n_slots] = True
+        return mask
+    if min_run <= 1 and max_starts is None:
+        return cheapest_slots(prices, n_slots)
+    return constrained_slots(prices, n_slots, min_run, max_starts)
+
+
+# Schedule a load of the given hours in the window [window_start, window_start + window_hours) of the prices.
+# Returns a Schedule, or None if the load does not fit in the window.
+def schedule_load(prices_df, hours, window_start=None, window_hours=None, contiguous=False, min_run_hours=0,
+                  max_starts=None, price_index=None):
+    price_index = price_index or PriceIndex(prices_df)
+    window = price_index.window_slots(window_start, window_hours)
+    if window is None:
+        return None
+    first, last = window
+    prices = price_index.prices[first:last]
+    slots_per_hour = price_index.slots_per_hour
+    n_slots = int(round(hours * slots_per_hour))
+    min_run = max(1, math.ceil(min_run_hours * slots_per_hour))
+
+    mask = optimize_slots(prices, n_slots, contiguous, min_run, max_starts)
+    if mask is None:
+        return None
+    total_price = prices[mask].sum()
+    return Schedule(price_index.timestamp_of(first), price_index.resolution, mask, total_price,
+                    total_price / n_slots if n_slots else None)
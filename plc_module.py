@@ -1,17 +1,24 @@
 # Purpose: This module contains functions for communicating with the PLC over Modbus TCP.
+import asyncio
 import logging
+from collections import namedtuple
 
-from pymodbus.client import ModbusTcpClient as ModbusClient
+from pymodbus.client import AsyncModbusTcpClient, ModbusTcpClient as ModbusClient
 from pymodbus.exceptions import ConnectionException, ModbusIOException
 
+from metrics_module import increment, span
+
 # IP address for the Moxa MGate 5103 device
 MOXA_IP_ADDRESS = '192.168.127.254'
 
+# Number of times the interactive PLC option may try to connect and write before giving up
+PLC_CONNECT_ATTEMPTS = 3
+
 
 # Setup plc modbus tcp client
-def setup_plc_client(IP_ADDRESS, PORT=502):
+def setup_plc_client(IP_ADDRESS, PORT=502, timeout=3):
     try:
-        client = ModbusClient(host=IP_ADDRESS, port=PORT)
+        client = ModbusClient(host=IP_ADDRESS, port=PORT, timeout=timeout)
         if client.connect():
             logging.info("PLC TCP client setup successful.")
             print("PLC TCP client setup successful.")
@@ -27,9 +34,9 @@ def setup_plc_client(IP_ADDRESS, PORT=502):
 # Write data to plc over Modbus TCP with enhanced diagnostics
 def write_data_to_plc(client, register_address, value, scaling_factor, unit_id=1):
     try:
-        # Ensure the socket is open before attempting to write
-        if not client.is_socket_open():
-            client.connect()
+        # Ensure the socket is open before attempting to write. setup_plc_client has usually connected already.
+        if not client.is_socket_open() and not client.connect():
+            raise ConnectionException("could not open the PLC connection")
 
         logging.info("Connected to the PLC over TCP/IP.")
 
@@ -37,19 +44,23 @@ def write_data_to_plc(client, register_address, value, scaling_factor, unit_id=1
         scaled_value = int(value * scaling_factor)
 
         # Write the scaled value to the specified register address
-        response = client.write_register(register_address, scaled_value, unit=unit_id)
+        with span('plc_write'):
+            response = client.write_register(register_address, scaled_value, slave=unit_id)
 
         # Check if the response indicates an error
         if response.isError():
+            increment('modbus_errors', kind='exception_response')
             logging.error(f"Failed to write value {scaled_value} to register address {register_address}. Error: {response}")
             return False
         else:
             logging.info(f"Successfully wrote value {scaled_value} to register address {register_address}.")
             return True
     except ModbusIOException as e:
+        increment('modbus_errors', kind='io')
         logging.error(f"Modbus IO Error while writing to PLC: {e}")
         return False
     except ConnectionException as e:
+        increment('modbus_errors', kind='connection')
         logging.error(f"Connection Error while writing to PLC: {e}")
         return False
     except Exception as e:
@@ -58,3 +69,351 @@ def write_data_to_plc(client, register_address, value, scaling_factor, unit_id=1
     finally:
         # It's usually a good idea to close the client, but you may wish to manage the connection elsewhere
         client.close()
+
+
+# Names of the price signals written to the PLC, in register order
+PLC_SIGNALS = ('price_difference', 'average_price', 'current_price', 'min_percentile', 'max_percentile')
+
+# Default register address for each price signal
+DEFAULT_REGISTER_MAP = {name: address for address, name in enumerate(PLC_SIGNALS)}
+
+
+# Build the price signals for the PLC, rounded to two decimals like the register preview
+def build_plc_signals(price_diff_eur, avg_price_eur, current_price_eur, y_min_percentile, x_max_percentile):
+    values = (price_diff_eur, avg_price_eur, current_price_eur, y_min_percentile, x_max_percentile)
+    return {name: round(value, 2) for name, value in zip(PLC_SIGNALS, values) if value is not None}
+
+
+# Map price signals onto register addresses using the given register map
+def map_signals_to_registers(signals, register_map=None):
+    register_map = register_map or DEFAULT_REGISTER_MAP
+    return {register_map[name]: value for name, value in signals.items() if name in register_map}
+
+
+# One PLC gateway to write the price signals to. register_map maps signal names to register addresses.
+PlcTarget = namedtuple('PlcTarget', ['name', 'host', 'port', 'unit_id', 'scaling_factor', 'register_map'])
+
+
+# Build the PLC targets from the PLC_TARGETS config list. Fields a target leaves out are taken from the
+# single-gateway settings, and an empty list gives one target for that gateway.
+def plc_targets_from_config(targets, host=MOXA_IP_ADDRESS, port=502, unit_id=1, scaling_factor=100):
+    if not targets:
+        return [PlcTarget(host, host, port, unit_id, scaling_factor, dict(DEFAULT_REGISTER_MAP))]
+    plc_targets = []
+    for target in targets:
+        target_host = target.get('HOST', host)
+        register_map = target.get('REGISTER_MAP') or dict(DEFAULT_REGISTER_MAP)
+        unknown_signals = set(register_map) - set(PLC_SIGNALS)
+        if unknown_signals:
+            raise ValueError(f"Unknown signals {sorted(unknown_signals)} in the register map of PLC target "
+                             f"{target_host}. Known signals: {', '.join(PLC_SIGNALS)}")
+        plc_targets.append(PlcTarget(target.get('NAME', target_host), target_host, target.get('PORT', port),
+                                     target.get('UNIT_ID', unit_id), target.get('SCALING_FACTOR', scaling_factor),
+                                     register_map))
+    names = [target.name for target in plc_targets]
+    if len(set(names)) != len(names):
+        raise ValueError(f"PLC target names must be unique: {names}")
+    return plc_targets
+
+
+# Range of the scaled values a 16-bit register holds, read as two's complement
+REGISTER_MIN = -0x8000
+REGISTER_MAX = 0x7FFF
+
+
+# Scale a value to a 16-bit register value, rounded to the nearest count. Negative prices are written as two's
+# complement. A value outside the register range is clamped to it and logged, instead of wrapping around.
+def scale_register_value(value, scaling_factor):
+    scaled = int(round(value * scaling_factor))
+    if not REGISTER_MIN <= scaled <= REGISTER_MAX:
+        clamped = min(max(scaled, REGISTER_MIN), REGISTER_MAX)
+        increment('register_clamped')
+        logging.warning(f"Value {value} does not fit a 16-bit register at scaling factor {scaling_factor}. "
+                        f"Writing {clamped / scaling_factor} instead.")
+        scaled = clamped
+    return scaled & 0xFFFF
+
+
+# Merge a {register_address: value} map into blocks of adjacent addresses: [(start_address, [values])]
+def build_register_blocks(registers, max_block_size=123):
+    blocks = []
+    for address in sorted(registers):
+        if blocks:
+            start, values = blocks[-1]
+            if start + len(values) == address and len(values) < max_block_size:
+                values.append(registers[address])
+                continue
+        blocks.append((address, [registers[address]]))
+    return blocks
+
+
+# Interpret a 16-bit register value as two's complement
+def signed_register_value(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+# Select the registers that need writing: those not in the shadow copy, or that moved more than the deadband.
+# Clean registers in gaps of at most max_gap between dirty ones are rewritten too, so the dirty registers coalesce
+# into fewer block writes.
+def select_dirty_registers(registers, shadow, deadband=0, max_gap=0):
+    dirty = {address: value for address, value in registers.items()
+             if address not in shadow
+             or abs(signed_register_value(value) - signed_register_value(shadow[address])) > deadband}
+    addresses = sorted(dirty)
+    for previous, current in zip(addresses, addresses[1:]):
+        gap = range(previous + 1, current)
+        if 0 < len(gap) <= max_gap and all(address in shadow for address in gap):
+            dirty.update({address: shadow[address] for address in gap})
+    return dirty
+
+
+# Pack a list of bits into 16-bit register values, least significant bit first
+def pack_bits(bits):
+    words = []
+    for offset in range(0, len(bits), 16):
+        words.append(sum(1 << index for index, bit in enumerate(bits[offset:offset + 16]) if bit))
+    return words
+
+
+# Register-map writer that keeps one Modbus TCP connection open across update cycles, on asyncio so PLC writes
+# never block the price fetching. Synchronous code drives it through write_signals_to_targets.
+# A shadow copy of the last written values is kept, and only registers that changed more than the deadband
+# (in scaled register counts) are written. With verify_on_connect, the shadow is filled by reading the registers
+# back once after each (re)connect; otherwise it is cleared, so everything is rewritten after a reconnect.
+# Every request has an explicit timeout, reconnects back off exponentially for a bounded number of attempts,
+# and an optional keepalive task polls the first written register to notice a dead gateway between writes.
+class AsyncPlcRegisterWriter:
+    def __init__(self, host=MOXA_IP_ADDRESS, port=502, scaling_factor=100, unit_id=1, timeout=3, deadband=0,
+                 verify_on_connect=False, max_gap=2, reconnect_attempts=5, reconnect_base=1, reconnect_cap=30):
+        self.host = host
+        self.port = port
+        self.scaling_factor = scaling_factor
+        self.unit_id = unit_id
+        self.timeout = timeout
+        self.deadband = deadband
+        self.verify_on_connect = verify_on_connect
+        self.max_gap = max_gap
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_base = reconnect_base
+        self.reconnect_cap = reconnect_cap
+        # pymodbus' own reconnect loop is disabled (reconnect_delay=0), reconnects are bounded here instead
+        self.client = AsyncModbusTcpClient(host, port=port, timeout=timeout, retries=0, reconnect_delay=0)
+        self.shadow = {}
+        self.coil_shadow = {}
+        self.verified = set()
+        self.lock = asyncio.Lock()
+        self.keepalive_task = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    # Connect if not connected, retrying with exponential backoff up to reconnect_attempts times
+    async def connect(self):
+        if self.client.connected:
+            return True
+        for attempt in range(self.reconnect_attempts):
+            if attempt:
+                delay = min(self.reconnect_cap, self.reconnect_base * 2 ** (attempt - 1))
+                logging.warning(f"Reconnecting to the PLC in {delay} seconds (attempt {attempt + 1}).")
+                await asyncio.sleep(delay)
+            try:
+                connected = await asyncio.wait_for(self.client.connect(), self.timeout)
+            except (asyncio.TimeoutError, OSError) as e:
+                logging.warning(f"Connecting to the PLC at {self.host}:{self.port} failed: {e!r}")
+                connected = False
+            if connected:
+                logging.info(f"Connected to the PLC at {self.host}:{self.port}.")
+                # The PLC may have restarted while disconnected, so the shadow copy can no longer be trusted
+                self.shadow.clear()
+                self.coil_shadow.clear()
+                self.verified.clear()
+                return True
+            increment('modbus_errors', kind='connect', host=self.host)
+            self.client.close()
+        logging.error(f"Failed to connect to the PLC at {self.host}:{self.port} "
+                      f"after {self.reconnect_attempts} attempts.")
+        return False
+
+    async def close(self):
+        await self.stop_keepalive()
+        self.client.close()
+        logging.info("PLC connection closed.")
+
+    # Start a background task that reads one register every interval seconds and reconnects if it fails
+    def start_keepalive(self, interval=30, address=0):
+        if self.keepalive_task is None or self.keepalive_task.done():
+            self.keepalive_task = asyncio.create_task(self._keepalive(interval, address))
+        return self.keepalive_task
+
+    async def stop_keepalive(self):
+        if self.keepalive_task is not None:
+            self.keepalive_task.cancel()
+            try:
+                await self.keepalive_task
+            except asyncio.CancelledError:
+                pass
+            self.keepalive_task = None
+
+    async def _keepalive(self, interval, address):
+        while True:
+            await asyncio.sleep(interval)
+            async with self.lock:
+                if not await self.connect():
+                    continue
+                try:
+                    response = await asyncio.wait_for(
+                        self.client.read_holding_registers(address, 1, slave=self.unit_id), self.timeout)
+                    # An exception response still proves the gateway is alive
+                    logging.debug(f"PLC keepalive response: {response}")
+                except (asyncio.TimeoutError, ModbusIOException, ConnectionException) as e:
+                    increment('modbus_errors', kind='keepalive', host=self.host)
+                    logging.warning(f"PLC keepalive failed: {e!r}. Reconnecting...")
+                    self.client.close()
+
+    # Write the registers of a {register_address: value} map that changed more than the deadband
+    async def write_registers(self, registers, force=False):
+        scaled = {address: scale_register_value(value, self.scaling_factor) for address, value in registers.items()}
+        return await self.write_raw_registers(scaled, self.deadband, force)
+
+    # Write the changed registers of a {register_address: 16-bit value} map as is, without scaling
+    async def write_raw_registers(self, registers, deadband=0, force=False):
+        async with self.lock:
+            return await self._write_raw_registers(registers, deadband, force)
+
+    async def _write_raw_registers(self, registers, deadband, force):
+        if not await self.connect():
+            return False
+        if self.verify_on_connect and not force:
+            await self._read_back(set(registers) - self.verified)
+        dirty = registers if force else select_dirty_registers(registers, self.shadow, deadband, self.max_gap)
+        if not dirty:
+            logging.info("PLC registers are up to date, nothing to write.")
+        for start_address, values in build_register_blocks(dirty):
+            if not await self._execute(lambda: self.client.write_registers(start_address, values, slave=self.unit_id),
+                                       f"values {values} to registers starting at {start_address}"):
+                return False
+            self.shadow.update(zip(range(start_address, start_address + len(values)), values))
+        return True
+
+    # Write an on/off mask, either as coils or packed 16 bits per register (bit i of register j is slot 16 * j + i)
+    async def write_bitmask(self, start_address, bits, as_coils=False, force=False):
+        bits = [bool(bit) for bit in bits]
+        if not as_coils:
+            words = pack_bits(bits)
+            return await self.write_raw_registers({start_address + offset: word for offset, word in enumerate(words)},
+                                                  force=force)
+        async with self.lock:
+            coils = dict(zip(range(start_address, start_address + len(bits)), bits))
+            if not force and all(self.coil_shadow.get(address) == bit for address, bit in coils.items()):
+                return True
+            if not await self._execute(lambda: self.client.write_coils(start_address, bits, slave=self.unit_id),
+                                       f"{len(bits)} coils starting at {start_address}"):
+                return False
+            self.coil_shadow.update(coils)
+            return True
+
+    # Fill the shadow copy by reading the given registers back from the PLC, one request per block
+    async def _read_back(self, addresses):
+        for start_address, values in build_register_blocks(dict.fromkeys(addresses, 0)):
+            try:
+                response = await asyncio.wait_for(
+                    self.client.read_holding_registers(start_address, len(values), slave=self.unit_id), self.timeout)
+                if response.isError():
+                    logging.warning(f"Could not read back registers starting at {start_address}: {response}")
+                    continue
+                self.shadow.update(zip(range(start_address, start_address + len(values)), response.registers))
+            except (asyncio.TimeoutError, ModbusIOException, ConnectionException) as e:
+                increment('modbus_errors', kind='read_back', host=self.host)
+                logging.warning(f"Could not read back registers starting at {start_address}: {e!r}")
+                return
+            self.verified.update(range(start_address, start_address + len(values)))
+
+    # Execute one write request with a timeout, reconnecting and retrying once if the connection has failed
+    async def _execute(self, request, description):
+        for attempt in range(2):
+            try:
+                if not await self.connect():
+                    return False
+                with span('plc_write', host=self.host):
+                    response = await asyncio.wait_for(request(), self.timeout)
+                if response.isError():
+                    increment('modbus_errors', kind='exception_response', host=self.host)
+                    logging.error(f"Failed to write {description}. Error: {response}")
+                    return False
+                logging.info(f"Successfully wrote {description}.")
+                return True
+            except (asyncio.TimeoutError, ModbusIOException, ConnectionException) as e:
+                increment('modbus_errors', kind='timeout' if isinstance(e, asyncio.TimeoutError) else 'io',
+                          host=self.host)
+                logging.warning(f"Modbus error while writing to PLC (attempt {attempt + 1}): {e!r}. Reconnecting...")
+                self.client.close()
+            except Exception as e:
+                logging.error(f"An unexpected error occurred while writing to PLC: {e}")
+                return False
+        logging.error(f"Failed to write {description} after reconnecting.")
+        return False
+
+
+# Writes the same price signals to several PLC targets concurrently, with one AsyncPlcRegisterWriter per target.
+# At most max_concurrency targets are written at a time. A slow or unreachable target only fails its own result,
+# so it never delays the others. Results are returned per target name.
+class PlcFanout:
+    def __init__(self, targets, max_concurrency=8, **writer_options):
+        self.targets = targets
+        self.writers = {target.name: AsyncPlcRegisterWriter(target.host, target.port, target.scaling_factor,
+                                                            target.unit_id, **writer_options)
+                        for target in targets}
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        await asyncio.gather(*(writer.close() for writer in self.writers.values()))
+
+    # Write the signals to every target through its own register map
+    async def write_signals(self, signals, force=False):
+        return await self._fan_out(lambda target, writer: writer.write_registers(
+            map_signals_to_registers(signals, target.register_map), force))
+
+    # Write the same on/off mask to every target
+    async def write_bitmask(self, start_address, bits, as_coils=False, force=False):
+        return await self._fan_out(lambda target, writer: writer.write_bitmask(start_address, bits, as_coils, force))
+
+    # Start a keepalive on every target, reading its lowest mapped register
+    def start_keepalive(self, interval=30):
+        return [self.writers[target.name].start_keepalive(interval, min(target.register_map.values(), default=0))
+                for target in self.targets]
+
+    async def _fan_out(self, operation):
+        results = await asyncio.gather(*(self._run(target, operation) for target in self.targets))
+        results = dict(zip((target.name for target in self.targets), results))
+        failed = [name for name, written in results.items() if not written]
+        if failed:
+            logging.error(f"Failed to write to PLC targets {failed}, wrote to {len(results) - len(failed)} "
+                          f"of {len(results)}.")
+        return results
+
+    async def _run(self, target, operation):
+        async with self.semaphore:
+            try:
+                return await operation(target, self.writers[target.name])
+            except Exception as e:
+                logging.error(f"An unexpected error occurred while writing to PLC target {target.name}: {e}")
+                return False
+
+
+# Write the signals to all targets from synchronous code and return {target name: written}
+def write_signals_to_targets(targets, signals, max_concurrency=8, **writer_options):
+    async def write():
+        async with PlcFanout(targets, max_concurrency, **writer_options) as fanout:
+            return await fanout.write_signals(signals)
+
+    return asyncio.run(write())
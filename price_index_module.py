@@ -0,0 +1,130 @@
+# Purpose: Timestamp-indexed price series for constant-time price lookups and cheapest-window queries.
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Time zone of the HourDK column and of naive timestamps passed to the lookups
+LOCAL_TIMEZONE = 'Europe/Copenhagen'
+
+# A window of consecutive slots: local start and end time and the average price over the window
+PriceWindow = namedtuple('PriceWindow', ['start', 'end', 'average_price'])
+
+
+# Return the UTC timestamps of the prices. HourUTC is used when present, otherwise HourDK is localized, which
+# needs the rows in time order to resolve the repeated hour when daylight saving time ends.
+def utc_timestamps(prices_df):
+    if 'HourUTC' in prices_df:
+        return prices_df['HourUTC'].to_numpy(dtype='datetime64[ns]')
+    local = pd.DatetimeIndex(prices_df['HourDK'])
+    utc = local.tz_localize(LOCAL_TIMEZONE, ambiguous='infer', nonexistent='shift_forward').tz_convert('UTC')
+    return utc.tz_localize(None).to_numpy(dtype='datetime64[ns]')
+
+
+# Convert a timestamp to naive UTC datetime64. Naive timestamps are taken to be local (Danish) time.
+def to_utc(timestamp):
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize(LOCAL_TIMEZONE, ambiguous=True, nonexistent='shift_forward')
+    return timestamp.tz_convert('UTC').tz_localize(None).to_datetime64()
+
+
+# Find the cheapest run of length consecutive prices with prefix sums. Missing (NaN) prices cannot be part of a run.
+# Returns (first slot, total price) or None if no run fits.
+def cheapest_contiguous_slots(prices, length):
+    if length <= 0 or length > len(prices):
+        return None
+    missing = np.isnan(prices)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(missing, 0.0, prices))))
+    gaps = np.concatenate(([0], np.cumsum(missing)))
+    window_sums = sums[length:] - sums[:-length]
+    window_sums[(gaps[length:] - gaps[:-length]) > 0] = np.inf
+    best = int(np.argmin(window_sums))
+    if np.isinf(window_sums[best]):
+        return None
+    return best, window_sums[best]
+
+
+# Price series stored in a fixed-size array, where slot i covers [start + i * resolution, start + (i + 1) * resolution)
+class PriceIndex:
+    def __init__(self, prices_df, price_column='SpotPriceEUR', resolution=None):
+        utc = utc_timestamps(prices_df)
+        prices = prices_df[price_column].to_numpy(dtype='float64')
+        order = np.argsort(utc, kind='stable')
+        utc, prices = utc[order], prices[order]
+        if len(utc) == 0:
+            raise ValueError("Cannot build a price index without prices.")
+
+        if resolution is None:
+            steps = np.diff(utc)
+            resolution = steps[steps > np.timedelta64(0)].min() if np.any(steps > np.timedelta64(0)) \
+                else np.timedelta64(1, 'h')
+        self.resolution = np.timedelta64(resolution, 'ns')
+        self.start = utc[0]
+        slots = (utc - self.start) // self.resolution
+        self.prices = np.full(int(slots[-1]) + 1, np.nan)
+        self.prices[slots] = prices
+
+    def __len__(self):
+        return len(self.prices)
+
+    @property
+    def end(self):
+        return self.start + len(self.prices) * self.resolution
+
+    @property
+    def slots_per_hour(self):
+        return int(np.timedelta64(1, 'h') // self.resolution) or 1
+
+    # Return the slot containing the timestamp, or None if it is outside the index
+    def slot_of(self, timestamp):
+        offset = to_utc(timestamp) - self.start
+        if offset < np.timedelta64(0):
+            return None
+        slot = int(offset // self.resolution)
+        return slot if slot < len(self.prices) else None
+
+    # Return the local start time of a slot
+    def timestamp_of(self, slot):
+        return pd.Timestamp(self.start + slot * self.resolution).tz_localize('UTC').tz_convert(LOCAL_TIMEZONE)
+
+    # Return the price at the timestamp, or None if there is no price for it
+    def price_at(self, timestamp):
+        slot = self.slot_of(timestamp)
+        if slot is None or np.isnan(self.prices[slot]):
+            return None
+        return self.prices[slot]
+
+    def price_now(self):
+        return self.price_at(pd.Timestamp.now(tz=LOCAL_TIMEZONE))
+
+    # Return the price h hours after the start of the index, which is correct on 23- and 25-hour days
+    def price_at_hour(self, hour):
+        slot = hour * self.slots_per_hour
+        if not 0 <= slot < len(self.prices) or np.isnan(self.prices[slot]):
+            return None
+        return self.prices[slot]
+
+    # Find the cheapest run of hours in [window_start, window_start + window_hours) using prefix sums.
+    # Returns a PriceWindow, or None if no complete run of prices fits in the window.
+    def cheapest_window(self, hours, window_start=None, window_hours=None):
+        window = self.window_slots(window_start, window_hours)
+        if window is None:
+            return None
+        first, last = window
+        length = int(hours * self.slots_per_hour)
+        best = cheapest_contiguous_slots(self.prices[first:last], length)
+        if best is None:
+            return None
+        start, total = best
+        return PriceWindow(self.timestamp_of(first + start), self.timestamp_of(first + start + length),
+                           total / length)
+
+    # Return the (first, last) slots of the window [window_start, window_start + window_hours), last exclusive
+    def window_slots(self, window_start=None, window_hours=None):
+        first = self.slot_of(window_start) if window_start is not None else 0
+        if first is None:
+            return None
+        if window_hours is None:
+            return first, len(self.prices)
+        return first, min(len(self.prices), first + int(window_hours * self.slots_per_hour))
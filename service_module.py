@@ -0,0 +1,238 @@
+# Purpose: Headless service that keeps the PLC registers up to date with the current spot-price statistics.
+import asyncio
+import logging
+import signal
+import threading
+from datetime import datetime as dt, timedelta
+
+import pandas as pd
+
+from api_module import HttpClient, fetch_startup_data
+from cache_module import DiskCache
+from config_module import *
+from data_processing_module import *
+from metrics_module import increment, start_metrics_server, write_metrics_file
+from optimizer_module import schedule_load
+from price_index_module import PriceIndex
+from plc_module import PlcFanout, build_plc_signals, plc_targets_from_config
+
+# Seconds to wait before retrying when the prices could not be fetched or are not published yet
+FETCH_RETRY_INTERVAL = 300
+
+# Seconds to wait before retrying a failed PLC write
+PLC_RETRY_INTERVAL = 60
+
+# Seconds to wait after the interval boundary, so the new interval is always picked up
+TICK_DELAY = 1
+
+
+# Seconds from now until just after the next price interval (hour or quarter) starts
+def seconds_until_next_interval(resolution=timedelta(hours=1), now=None):
+    now = pd.Timestamp(now or dt.now())
+    next_interval = now.floor(resolution) + resolution
+    return (next_interval - now).total_seconds() + TICK_DELAY
+
+
+# Fetch the exchange rate and today's prices, and return the processed DataFrame or None on failure
+def refresh_prices(cache=None, client=None):
+    api_key_valid, conversion_rate_dkk_to_eur, data, status_code = fetch_startup_data(
+        api_key, exchange_rate_api_url, electricity_prices_api_url, cache=cache, client=client)
+    if api_key_valid is False:
+        logging.error("Invalid API key for the exchange rate API.")
+        return None
+    if not data or not conversion_rate_dkk_to_eur:
+        logging.error(f"Service could not refresh prices. Status code: {status_code}")
+        return None
+    prices_df = process_data(data, conversion_rate_dkk_to_eur)
+    if prices_df.empty:
+        logging.warning("No prices published for today yet.")
+        return None
+    logging.info(f"Service refreshed {len(prices_df)} prices for {dt.now().date()}.")
+    return prices_df
+
+
+# Calculate the price signals for the current interval, looking the current price up in the price index if given
+def compute_signals(prices_df, x, y, price_index=None):
+    x_quantile, y_quantile = 1 - float(x), float(y)
+    statistics = calculate_daily_statistics(prices_df, (x_quantile, y_quantile))
+    current_price = price_index.price_now() if price_index is not None else statistics.current_price
+    return build_plc_signals(statistics.spread, statistics.mean, current_price,
+                             statistics.percentiles[y_quantile], statistics.percentiles[x_quantile])
+
+
+# Write today's cheapest-hours load schedule to every PLC target as an on/off bitmask
+async def write_load_schedule(fanout, prices_df, price_index, schedule):
+    load_schedule = schedule_load(prices_df, schedule['LOAD_HOURS'], contiguous=schedule.get('CONTIGUOUS', False),
+                                  min_run_hours=schedule.get('MIN_RUN_HOURS', 0),
+                                  max_starts=schedule.get('MAX_STARTS'), price_index=price_index)
+    if load_schedule is None:
+        logging.error(f"Could not schedule a load of {schedule['LOAD_HOURS']} hours in today's prices.")
+        return False
+    logging.info(f"Scheduled {schedule['LOAD_HOURS']} hours from {load_schedule.start} "
+                 f"at an average of {load_schedule.average_price:.2f} EUR/MWh.")
+    results = await fanout.write_bitmask(schedule['REGISTER_ADDRESS'], load_schedule.mask,
+                                         schedule.get('AS_COILS', False))
+    return all(results.values())
+
+
+# Set the stop event on SIGTERM and SIGINT so the service shuts down cleanly
+def install_signal_handlers(stop_event):
+    def handle_signal(signum, frame):
+        logging.info(f"Received signal {signum}. Stopping service.")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+
+# Today's prices shared between the fetch and PLC tasks. The updated event wakes the PLC task after a refresh.
+class PriceState:
+    def __init__(self):
+        self.prices_df = None
+        self.date = None
+        self.price_index = None
+        self.resolution = timedelta(hours=1)
+        self.updated = asyncio.Event()
+
+    def is_current(self):
+        return self.prices_df is not None and self.date == dt.now().date()
+
+
+# Export the day's prices and percentiles to the archive directory in the configured formats
+def archive_prices(prices_df, x, y, prices_date):
+    from excel_module import export_daily_archive
+
+    percentiles_df = calculate_percentiles(prices_df, x, y)[0]
+    return export_daily_archive(prices_df, percentiles_df, archive_formats, archive_dir, prices_date)
+
+
+# Fetch today's prices once per day in a worker thread, so slow or retried requests never hold up the PLC writes.
+# The daily archive is exported in a worker thread as well, after the PLC task has been woken with the new prices.
+# An error in a cycle is logged and the cycle retried after FETCH_RETRY_INTERVAL, so the task never dies silently.
+async def keep_prices_fresh(state, cache, client, x, y):
+    while True:
+        if state.is_current():
+            await asyncio.sleep(seconds_until_next_interval(timedelta(days=1)))
+            continue
+        try:
+            await refresh_state(state, cache, client, x, y)
+        except Exception:
+            logging.exception("Service failed to refresh the prices.")
+            increment('service_errors', task='prices')
+        if not state.is_current():
+            await asyncio.sleep(FETCH_RETRY_INTERVAL)
+
+
+# Fetch today's prices into the state, wake the PLC task and export the daily archive
+async def refresh_state(state, cache, client, x, y):
+    today = dt.now().date()
+    await asyncio.to_thread(cache.prune)
+    prices_df = await asyncio.to_thread(refresh_prices, cache, client)
+    if prices_df is None:
+        return
+    state.prices_df = prices_df
+    state.date = today
+    state.price_index = PriceIndex(prices_df)
+    state.resolution = infer_resolution(prices_df)
+    state.updated.set()
+    if archive_formats:
+        await asyncio.to_thread(archive_prices, prices_df, x, y, today)
+
+
+# Write the registers at every interval boundary, and as soon as new prices arrive
+# Targets that failed are retried after PLC_RETRY_INTERVAL; the others skip unchanged registers on the retry.
+# An error in a cycle, e.g. from invalid percentiles, is logged and the cycle retried after PLC_RETRY_INTERVAL.
+async def keep_registers_updated(state, fanout, x, y, modbus_server=None):
+    while True:
+        state.updated.clear()
+        delay = None
+        if state.is_current():
+            try:
+                written = await update_registers(state, fanout, x, y, modbus_server)
+            except Exception:
+                logging.exception("Service failed to update the registers.")
+                increment('service_errors', task='registers')
+                written = False
+            delay = seconds_until_next_interval(state.resolution)
+            if not written:
+                delay = min(PLC_RETRY_INTERVAL, delay)
+            if metrics_file:
+                await asyncio.to_thread(write_metrics_file, metrics_file)
+        try:
+            await asyncio.wait_for(state.updated.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Write the signals for the current interval, and the load schedule if configured, to the PLC targets.
+# The Modbus server, if given, is updated first, so its clients never wait for slow PLC gateways.
+# Returns whether everything was written.
+async def update_registers(state, fanout, x, y, modbus_server=None):
+    signals = compute_signals(state.prices_df, x, y, state.price_index)
+    if modbus_server is not None:
+        modbus_server.update(signals, state.price_index.prices, state.resolution / timedelta(minutes=1))
+    results = await fanout.write_signals(signals)
+    written = all(results.values())
+    if schedule_config:
+        written = await write_load_schedule(fanout, state.prices_df, state.price_index, schedule_config) and written
+    if written:
+        logging.info(f"Service wrote signals for {dt.now():%H:%M} to {len(results)} PLC targets: {signals}")
+    else:
+        logging.error("Service failed to write registers.")
+    return written
+
+
+# Run the price fetching and PLC writing as concurrent tasks until the stop event is set
+async def run_service_async(stop_event):
+    cache = DiskCache()
+    client = HttpClient(connect_timeout=connect_timeout, read_timeout=timeout, max_retries=max_retries,
+                        sleep=stop_event.wait)
+    x_last, y_last = load_cached_percentiles(cache)
+    x = x_last or percentile_max
+    y = y_last or percentile_min
+
+    state = PriceState()
+    targets = plc_targets_from_config(plc_targets, plc_host, plc_port, unit_id, scaling_factor)
+    fanout = PlcFanout(targets, plc_max_concurrency, timeout=plc_timeout, deadband=plc_deadband,
+                       verify_on_connect=plc_verify_on_connect)
+    logging.info(f"Service started with percentiles x={x}, y={y} for PLC targets {[t.name for t in targets]}.")
+
+    metrics_server = start_metrics_server(metrics_port) if metrics_port else None
+    modbus_server = None
+    if modbus_server_port is not None:
+        from modbus_server_module import PriceRegisterServer
+
+        modbus_server = PriceRegisterServer(modbus_server_host, modbus_server_port, scaling_factor)
+        await modbus_server.start()
+    tasks = [asyncio.create_task(keep_prices_fresh(state, cache, client, x, y)),
+             asyncio.create_task(keep_registers_updated(state, fanout, x, y, modbus_server))]
+    if plc_keepalive_interval:
+        tasks.extend(fanout.start_keepalive(plc_keepalive_interval))
+    try:
+        # The stop event is set from a signal handler or another thread, so wait for it in a worker thread.
+        # A task that still ends on an error stops the service, instead of leaving it running without that task.
+        stop_waiter = asyncio.create_task(asyncio.to_thread(stop_event.wait))
+        done, _ = await asyncio.wait([stop_waiter, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        for task in done - {stop_waiter}:
+            logging.error("Service task ended unexpectedly. Stopping service.", exc_info=task.exception())
+        stop_event.set()
+        await stop_waiter
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await fanout.close()
+        client.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if modbus_server is not None:
+            await modbus_server.stop()
+        logging.info("Service stopped.")
+
+
+# Run the service until the stop event is set
+def run_service(stop_event=None):
+    stop_event = stop_event or threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        install_signal_handlers(stop_event)
+    asyncio.run(run_service_async(stop_event))
@@ -0,0 +1,141 @@
+# Purpose: Streaming ingest of large Energi Data Service responses straight into typed column buffers.
+import codecs
+import json
+import re
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from api_module import default_client
+from data_processing_module import COLUMN_ALIASES
+
+# Bytes read from the response body at a time
+CHUNK_SIZE = 64 * 1024
+
+# Records requested per page
+PAGE_SIZE = 10000
+
+# Records parsed between flushes of the timestamp strings into the int64 buffers
+BATCH_SIZE = 4096
+
+# Column types, by the Elspotprices column names
+TIME_COLUMNS = ('HourUTC', 'HourDK')
+PRICE_COLUMNS = ('SpotPriceDKK', 'SpotPriceEUR')
+CATEGORY_COLUMNS = ('PriceArea',)
+
+# Whitespace and separators between records
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+# Parse the objects of the top-level "records" array from an iterable of byte chunks, yielding one record at a time.
+# Only the unparsed tail of the body is kept in memory.
+def iter_json_records(chunks):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_records = False
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        if not in_records:
+            key = buffer.find('"records"')
+            bracket = buffer.find('[', key) if key >= 0 else -1
+            if bracket < 0:
+                # Keep enough of the tail to find a key split across chunks
+                buffer = buffer[max(key, len(buffer) - 16):] if key >= 0 else buffer[-16:]
+                continue
+            buffer = buffer[bracket + 1:]
+            in_records = True
+
+        position = 0
+        while True:
+            position = _SEPARATORS.match(buffer, position).end()
+            if position >= len(buffer):
+                break
+            if buffer[position] == ']':
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # The record continues in the next chunk
+            yield record
+        buffer = buffer[position:]
+
+
+# Typed column buffers for price records: int64 seconds for timestamps, float64 for prices and codes for categories
+class PriceColumnBuffers:
+    def __init__(self):
+        self.times = {}
+        self.prices = {}
+        self.categories = {}
+        self.pending_times = {}
+        self.rows = 0
+
+    def _init_columns(self, record):
+        for key in record:
+            column = COLUMN_ALIASES.get(key, key)
+            if column in TIME_COLUMNS:
+                self.times[key] = array('q')
+                self.pending_times[key] = []
+            elif column in PRICE_COLUMNS:
+                self.prices[key] = array('d')
+            elif column in CATEGORY_COLUMNS:
+                self.categories[key] = (array('i'), {})
+
+    # Parse the pending timestamp strings in one vectorized call and move them into the int64 buffers
+    def _flush_times(self):
+        for key, pending in self.pending_times.items():
+            if pending:
+                parsed = np.array(pending, dtype='datetime64[s]').astype(np.int64)
+                self.times[key].frombytes(parsed.tobytes())
+                pending.clear()
+
+    # Append records to the buffers. Returns the number of records added.
+    def extend(self, records):
+        added = 0
+        for record in records:
+            if self.rows == 0 and added == 0:
+                self._init_columns(record)
+            for key, pending in self.pending_times.items():
+                pending.append(record[key])
+            for key, values in self.prices.items():
+                value = record[key]
+                values.append(np.nan if value is None else value)
+            for key, (codes, lookup) in self.categories.items():
+                codes.append(lookup.setdefault(record[key], len(lookup)))
+            added += 1
+            if added % BATCH_SIZE == 0:
+                self._flush_times()
+        self._flush_times()
+        self.rows += added
+        return added
+
+    # Build a DataFrame with the Elspotprices column names from the buffers
+    def to_frame(self):
+        columns = {}
+        for key, values in self.times.items():
+            columns[COLUMN_ALIASES.get(key, key)] = np.frombuffer(values, dtype=np.int64).astype('datetime64[s]')
+        for key, (codes, lookup) in self.categories.items():
+            columns[COLUMN_ALIASES.get(key, key)] = pd.Categorical.from_codes(np.frombuffer(codes, dtype=np.int32),
+                                                                              list(lookup))
+        for key, values in self.prices.items():
+            columns[COLUMN_ALIASES.get(key, key)] = np.frombuffer(values, dtype=np.float64)
+        return pd.DataFrame(columns)
+
+
+# Fetch all records for the query, page by page with offset/limit, streaming each page into column buffers.
+# Peak memory is the column buffers plus one chunk of the response body, whatever the size of the range.
+def fetch_price_columns(dataset_url, params, client=None, page_size=PAGE_SIZE):
+    client = client or default_client()
+    buffers = PriceColumnBuffers()
+    offset = 0
+    while True:
+        response = client.get(dataset_url, params={**params, 'offset': offset, 'limit': page_size}, stream=True)
+        try:
+            response.raise_for_status()
+            count = buffers.extend(iter_json_records(response.iter_content(CHUNK_SIZE)))
+        finally:
+            response.close()
+        offset += count
+        if count < page_size:
+            return buffers.to_frame()
@@ -0,0 +1,155 @@
+import email.utils
+import time
+from datetime import datetime as dt, timedelta
+
+import pytest
+import requests
+
+from api_module import HttpClient, fetch_electricity_prices, fetch_exchange_rate_checked
+from cache_module import DiskCache
+
+
+# Day-ahead price records for a day, in the DayAheadPrices format
+def price_records(day):
+    start = dt.combine(day, dt.min.time())
+    return [{'TimeUTC': (start + timedelta(hours=hour - 1)).isoformat(),
+             'TimeDK': (start + timedelta(hours=hour)).isoformat(),
+             'DayAheadPriceDKK': 500.0 + hour} for hour in range(24)]
+
+
+@pytest.fixture
+def client():
+    client = HttpClient(connect_timeout=2, read_timeout=5, max_retries=1, sleep=lambda seconds: None)
+    yield client
+    client.close()
+
+
+# Client that records the backoff delays instead of sleeping
+def recording_client(max_retries=3, **kwargs):
+    sleeps = []
+    client = HttpClient(connect_timeout=2, read_timeout=5, max_retries=max_retries, sleep=sleeps.append, **kwargs)
+    return client, sleeps
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DiskCache(str(tmp_path))
+
+
+def test_prices_are_cached_for_the_day(http_server, client, cache):
+    payload = {'records': price_records(dt.now().date())}
+    http_server.respond(200, payload)
+    assert fetch_electricity_prices(http_server.url, cache=cache, client=client) == (payload, 200)
+    assert fetch_electricity_prices(http_server.url, cache=cache, client=client) == (payload, 200)
+    assert len(http_server.requests) == 1
+
+
+def test_prices_for_another_day_are_not_cached(http_server, client, cache):
+    yesterday = {'records': price_records(dt.now().date() - timedelta(days=1))}
+    today = {'records': price_records(dt.now().date())}
+    http_server.respond(200, yesterday)
+    http_server.respond(200, today)
+    assert fetch_electricity_prices(http_server.url, cache=cache, client=client) == (yesterday, 200)
+    assert fetch_electricity_prices(http_server.url, cache=cache, client=client) == (today, 200)
+    assert fetch_electricity_prices(http_server.url, cache=cache, client=client) == (today, 200)
+    assert len(http_server.requests) == 2
+
+
+def test_cached_prices_for_another_day_are_ignored(http_server, client, cache):
+    key = DiskCache.make_key('prices', http_server.url, dt.now().date().isoformat())
+    cache.put(key, {'records': price_records(dt.now().date() - timedelta(days=1))}, etag='"old"')
+    today = {'records': price_records(dt.now().date())}
+    http_server.respond(200, today)
+    assert fetch_electricity_prices(http_server.url, cache=cache, client=client) == (today, 200)
+    # Not revalidated, as a 304 would keep the wrong day
+    assert 'If-None-Match' not in http_server.requests[0][1]
+
+
+def test_stale_exchange_rate_is_revalidated(http_server, client, cache):
+    http_server.respond(200, {'rates': {'EUR': 0.134}}, {'ETag': '"v1"'})
+    http_server.respond(304)
+    assert fetch_exchange_rate_checked('key', http_server.url, cache=cache, client=client) == (0.134, True)
+
+    # Expire the entry, so the next fetch asks the server whether it changed
+    key = DiskCache.make_key('fx', http_server.url)
+    entry = cache.get(key)
+    cache.put(key, entry['payload'], 0, entry['etag'])
+    assert fetch_exchange_rate_checked('key', http_server.url, cache=cache, client=client) == (0.134, True)
+    assert http_server.requests[1][1]['If-None-Match'] == '"v1"'
+    assert DiskCache.is_fresh(cache.get(key))
+
+
+def test_offline_falls_back_to_the_cache(closed_port, client, cache):
+    url = f'http://127.0.0.1:{closed_port}/'
+    assert fetch_exchange_rate_checked('key', url, cache=cache, client=client) == (None, None)
+    assert fetch_electricity_prices(url, cache=cache, client=client) == (None, 'N/A')
+
+    cache.put(DiskCache.make_key('fx', url), {'rates': {'EUR': 0.134}}, 0)
+    assert fetch_exchange_rate_checked('key', url, cache=cache, client=client) == (0.134, True)
+
+
+@pytest.mark.parametrize('max_retries', [0, 1])
+def test_get_always_makes_one_attempt(http_server, max_retries):
+    http_server.respond(503)
+    client, sleeps = recording_client(max_retries)
+    assert client.get(http_server.url).status_code == 503
+    assert client.get(http_server.url, max_retries=0).status_code == 503
+    assert len(http_server.requests) == 2
+    assert sleeps == []
+
+
+def test_get_retries_server_errors(http_server):
+    http_server.respond(500)
+    http_server.respond(502)
+    http_server.respond(200, {'ok': True})
+    client, sleeps = recording_client(3, backoff_base=1, backoff_cap=60)
+    response = client.get(http_server.url)
+    assert response.status_code == 200 and response.json() == {'ok': True}
+    assert len(http_server.requests) == 3
+    # Jittered exponential backoff: up to 1 s after the first attempt, up to 2 s after the second
+    assert len(sleeps) == 2 and 0 <= sleeps[0] <= 1 and 0 <= sleeps[1] <= 2
+
+
+def test_get_returns_the_last_response_when_the_attempts_run_out(http_server):
+    http_server.respond(503)
+    client, sleeps = recording_client(3)
+    assert client.get(http_server.url).status_code == 503
+    assert len(http_server.requests) == 3
+    assert len(sleeps) == 2
+
+
+def test_get_waits_for_retry_after_on_429(http_server):
+    http_server.respond(429, headers={'Retry-After': '7'})
+    http_server.respond(200)
+    client, sleeps = recording_client(3)
+    assert client.get(http_server.url).status_code == 200
+    assert sleeps == [7.0]
+
+
+def test_backoff_delay_parses_retry_after():
+    client, _ = recording_client(backoff_cap=60)
+    response = requests.Response()
+    response.headers['Retry-After'] = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= client.backoff_delay(0, response) <= 30
+    response.headers['Retry-After'] = '3600'
+    assert client.backoff_delay(0, response) == 60
+    response.headers['Retry-After'] = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert client.backoff_delay(0, response) == 0
+    # An unparsable value falls back to the jittered backoff
+    response.headers['Retry-After'] = 'soon'
+    assert 0 <= client.backoff_delay(2, response) <= 4
+
+
+def test_get_does_not_retry_client_errors(http_server):
+    http_server.respond(401)
+    client, sleeps = recording_client(3)
+    assert fetch_exchange_rate_checked('key', http_server.url, client=client) == (None, False)
+    assert len(http_server.requests) == 1
+    assert sleeps == []
+
+
+def test_get_retries_connection_errors_then_raises(closed_port):
+    client, sleeps = recording_client(3)
+    with pytest.raises(requests.ConnectionError):
+        client.get(f'http://127.0.0.1:{closed_port}/')
+    assert len(sleeps) == 2
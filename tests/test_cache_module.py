@@ -0,0 +1,67 @@
+import os
+import time
+from datetime import datetime as dt, timedelta
+
+from cache_module import DiskCache, conditional_headers, exchange_rate_expiry, prices_cover_date
+
+
+def test_put_and_get_round_trip(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    key = DiskCache.make_key('prices', 'http://example/prices', '2024-03-01')
+    assert cache.get(key) is None
+    cache.put(key, {'records': [1, 2]}, expires_at=None, etag='"v1"', last_modified='Fri, 01 Mar 2024 12:00:00 GMT')
+    entry = cache.get(key)
+    assert entry['payload'] == {'records': [1, 2]}
+    assert conditional_headers(entry) == {'If-None-Match': '"v1"',
+                                          'If-Modified-Since': 'Fri, 01 Mar 2024 12:00:00 GMT'}
+
+
+def test_make_key_depends_on_the_price_date():
+    url = 'http://example/prices'
+    assert DiskCache.make_key('prices', url, '2024-03-01') != DiskCache.make_key('prices', url, '2024-03-02')
+    assert DiskCache.make_key('fx', url) == DiskCache.make_key('fx', url)
+
+
+def test_is_fresh_honours_the_expiry():
+    now = time.time()
+    assert not DiskCache.is_fresh(None)
+    assert DiskCache.is_fresh({'expires_at': None})
+    assert DiskCache.is_fresh({'expires_at': now + 60}, now=now)
+    assert not DiskCache.is_fresh({'expires_at': now - 1}, now=now)
+
+
+def test_exchange_rate_expires_at_the_next_midnight():
+    midnight = dt.combine(dt.now().date() + timedelta(days=1), dt.min.time()).timestamp()
+    assert exchange_rate_expiry({}) == midnight
+
+
+def test_revalidate_extends_the_expiry_and_keeps_the_validators(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    entry = cache.put('fx-test', {'rates': {'EUR': 0.134}}, time.time() - 10, etag='"v1"')
+    assert not DiskCache.is_fresh(cache.get('fx-test'))
+    cache.revalidate('fx-test', entry, time.time() + 60)
+    revalidated = cache.get('fx-test')
+    assert DiskCache.is_fresh(revalidated)
+    assert revalidated['etag'] == '"v1"'
+    assert revalidated['payload'] == {'rates': {'EUR': 0.134}}
+
+
+def test_prune_removes_old_entries_but_keeps_the_settings(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.put('old', {})
+    cache.put('new', {})
+    cache.save_setting('percentiles', [0.66, 0.33])
+    old_entry = cache.get('old')
+    old_entry['fetched_at'] = time.time() - 31 * 86400
+    cache._write_json('old.json', old_entry)
+
+    cache.prune(max_age_days=30)
+    assert sorted(os.listdir(tmp_path)) == ['new.json', 'settings.json']
+    assert cache.load_setting('percentiles') == [0.66, 0.33]
+
+
+def test_prices_cover_date():
+    assert prices_cover_date({'records': [{'TimeDK': '2024-03-01T00:00:00'}]}, '2024-03-01')
+    assert prices_cover_date({'records': [{'HourDK': '2024-03-01T23:00:00'}]}, '2024-03-01')
+    assert not prices_cover_date({'records': [{'TimeDK': '2024-02-29T00:00:00'}]}, '2024-03-01')
+    assert not prices_cover_date({'records': []}, '2024-03-01')
@@ -0,0 +1,123 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from optimizer_module import constrained_slots, optimize_slots, schedule_load
+
+
+# Return the lengths of the runs of consecutive slots switched on
+def run_lengths(mask):
+    return [len(list(group)) for on, group in itertools.groupby(mask) if on]
+
+
+# Return whether a mask switches on n_slots priced slots, in runs of at least min_run, with at most max_starts runs
+def is_feasible(mask, prices, n_slots, min_run=1, max_starts=None):
+    runs = run_lengths(mask)
+    return (sum(runs) == n_slots and not np.isnan(prices[mask]).any() and all(run >= min_run for run in runs)
+            and (max_starts is None or len(runs) <= max_starts))
+
+
+# Lowest total price of any feasible mask, found by trying every set of n_slots slots, or None if none fits
+def brute_force_total(prices, n_slots, min_run=1, max_starts=None):
+    best = None
+    for on in itertools.combinations(range(len(prices)), n_slots):
+        mask = np.zeros(len(prices), dtype=bool)
+        mask[list(on)] = True
+        if is_feasible(mask, prices, n_slots, min_run, max_starts):
+            total = prices[mask].sum()
+            best = total if best is None else min(best, total)
+    return best
+
+
+# Check a mask against brute force: infeasible exactly when brute force finds nothing, otherwise feasible and as cheap
+def assert_optimal(mask, prices, n_slots, min_run=1, max_starts=None):
+    best = brute_force_total(prices, n_slots, min_run, max_starts)
+    if best is None:
+        assert mask is None
+    else:
+        assert mask is not None and is_feasible(mask, prices, n_slots, min_run, max_starts)
+        assert prices[mask].sum() == pytest.approx(best)
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_constrained_slots_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    n_total = int(rng.integers(1, 11))
+    prices = rng.integers(-20, 100, n_total).astype('float64')
+    # Some cases with missing prices, which can never be switched on
+    if seed % 3 == 0:
+        prices[rng.choice(n_total, size=max(1, n_total // 4), replace=False)] = np.nan
+    n_slots = int(rng.integers(0, n_total + 1))
+    min_run = int(rng.integers(1, 4))
+    max_starts = None if seed % 4 == 0 else int(rng.integers(1, 4))
+    assert_optimal(constrained_slots(prices, n_slots, min_run, max_starts), prices, n_slots, min_run, max_starts)
+
+
+def test_min_run_keeps_runs_together():
+    prices = np.array([1, 50, 2, 50, 3, 4, 50, 50], dtype='float64')
+    mask = constrained_slots(prices, 4, min_run=2)
+    assert all(run >= 2 for run in run_lengths(mask))
+    assert_optimal(mask, prices, 4, min_run=2)
+
+
+def test_max_starts_limits_the_number_of_runs():
+    prices = np.array([1, 90, 1, 90, 1, 90, 1], dtype='float64')
+    assert run_lengths(constrained_slots(prices, 4, max_starts=4)) == [1, 1, 1, 1]
+    mask = constrained_slots(prices, 4, max_starts=2)
+    assert len(run_lengths(mask)) <= 2
+    assert_optimal(mask, prices, 4, max_starts=2)
+
+
+def test_missing_prices_are_never_switched_on():
+    prices = np.array([5, np.nan, 1, 2, np.nan, 0], dtype='float64')
+    mask = constrained_slots(prices, 3, min_run=1, max_starts=3)
+    assert not mask[1] and not mask[4]
+    assert_optimal(mask, prices, 3, max_starts=3)
+
+
+def test_load_that_does_not_fit_returns_none():
+    prices = np.array([1, 2, np.nan, 3, 4], dtype='float64')
+    # No run of three priced slots
+    assert constrained_slots(prices, 3, min_run=3) is None
+    # Four slots in one run do not fit between the missing price
+    assert constrained_slots(prices, 4, max_starts=1) is None
+    assert optimize_slots(prices, 5) is None
+    assert optimize_slots(prices, 3, contiguous=True) is None
+
+
+def test_zero_slots_switches_nothing_on():
+    assert not constrained_slots(np.array([1.0, 2.0]), 0, min_run=2).any()
+
+
+# A day of hourly prices starting at midnight, local time
+def hourly_prices(prices):
+    hours = pd.date_range('2024-03-01', periods=len(prices), freq='h')
+    return pd.DataFrame({'HourDK': hours, 'SpotPriceEUR': np.asarray(prices, dtype='float64')})
+
+
+@pytest.mark.parametrize('hours, min_run_hours, max_starts', [(3, 0, None), (4, 2, None), (4, 1, 2), (6, 2, 2),
+                                                             (5, 3, 1)])
+def test_schedule_load_matches_brute_force(hours, min_run_hours, max_starts):
+    prices = np.random.default_rng(hours * 10 + min_run_hours).integers(0, 100, 12).astype('float64')
+    prices[7] = np.nan
+    schedule = schedule_load(hourly_prices(prices), hours, min_run_hours=min_run_hours, max_starts=max_starts)
+    min_run = max(1, min_run_hours)
+    best = brute_force_total(prices, hours, min_run, max_starts)
+    if best is None:
+        assert schedule is None
+    else:
+        assert is_feasible(schedule.mask, prices, hours, min_run, max_starts)
+        assert schedule.total_price == pytest.approx(best)
+        assert schedule.average_price == pytest.approx(best / hours)
+        assert schedule.start == pd.Timestamp('2024-03-01', tz='Europe/Copenhagen')
+
+
+def test_schedule_load_in_a_window():
+    prices = [1, 1, 1, 50, 40, 30, 20, 10, 1, 1]
+    schedule = schedule_load(hourly_prices(prices), 2, window_start=pd.Timestamp('2024-03-01 03:00'),
+                             window_hours=5, contiguous=True)
+    assert schedule.start == pd.Timestamp('2024-03-01 03:00', tz='Europe/Copenhagen')
+    assert list(np.flatnonzero(schedule.mask)) == [3, 4]
+    assert schedule.total_price == 30
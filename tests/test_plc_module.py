@@ -0,0 +1,144 @@
+import asyncio
+import logging
+
+from plc_module import (AsyncPlcRegisterWriter, PlcFanout, build_register_blocks, pack_bits, plc_targets_from_config,
+                        scale_register_value, select_dirty_registers, signed_register_value)
+
+
+def test_scale_register_value_rounds_to_the_nearest_count():
+    assert scale_register_value(123.45, 100) == 12345
+    assert scale_register_value(26.8, 100) == 2680
+    assert signed_register_value(scale_register_value(-1.5, 100)) == -150
+
+
+def test_scale_register_value_clamps_out_of_range_values(caplog):
+    with caplog.at_level(logging.WARNING):
+        assert scale_register_value(700, 100) == 0x7FFF
+        assert signed_register_value(scale_register_value(-700, 100)) == -0x8000
+    assert len(caplog.records) == 2
+    assert "does not fit a 16-bit register" in caplog.records[0].getMessage()
+
+
+def test_build_register_blocks_merges_adjacent_addresses():
+    blocks = build_register_blocks({0: 1, 1: 2, 2: 3, 5: 4, 6: 5, 10: 6})
+    assert blocks == [(0, [1, 2, 3]), (5, [4, 5]), (10, [6])]
+
+
+def test_build_register_blocks_splits_at_the_block_size():
+    blocks = build_register_blocks(dict.fromkeys(range(5), 0), max_block_size=2)
+    assert [(start, len(values)) for start, values in blocks] == [(0, 2), (2, 2), (4, 1)]
+
+
+def test_select_dirty_registers_applies_the_deadband():
+    shadow = {0: 100, 1: 200, 2: 300}
+    dirty = select_dirty_registers({0: 101, 1: 205, 2: 300, 3: 1}, shadow, deadband=2)
+    assert dirty == {1: 205, 3: 1}
+
+
+def test_select_dirty_registers_compares_negative_values_signed():
+    shadow = {0: scale_register_value(-0.01, 100)}
+    assert select_dirty_registers({0: scale_register_value(0.01, 100)}, shadow, deadband=2) == {}
+
+
+def test_select_dirty_registers_fills_small_gaps():
+    shadow = {0: 1, 1: 2, 2: 3, 3: 4}
+    dirty = select_dirty_registers({0: 9, 1: 2, 2: 3, 3: 9}, shadow, max_gap=2)
+    assert dirty == {0: 9, 1: 2, 2: 3, 3: 9}
+    assert select_dirty_registers({0: 9, 1: 2, 2: 3, 3: 9}, shadow, max_gap=1) == {0: 9, 3: 9}
+
+
+def test_pack_bits_is_least_significant_bit_first():
+    assert pack_bits([1, 0, 1]) == [0b101]
+    assert pack_bits([0] * 16 + [1]) == [0, 1]
+
+
+def test_writer_writes_adjacent_registers_in_one_request(modbus_server):
+    async def scenario():
+        async with AsyncPlcRegisterWriter('127.0.0.1', modbus_server.port) as writer:
+            assert await writer.write_registers({0: 308.2, 1: 154.1, 2: -26.8, 3: 101.71, 4: 104.79})
+
+    asyncio.run(scenario())
+    assert modbus_server.registers.writes == 1
+    values = modbus_server.registers.getValues(0, 5)
+    assert [signed_register_value(value) for value in values] == [30820, 15410, -2680, 10171, 10479]
+
+
+def test_writer_skips_registers_within_the_deadband(modbus_server):
+    async def scenario():
+        async with AsyncPlcRegisterWriter('127.0.0.1', modbus_server.port, deadband=5) as writer:
+            assert await writer.write_registers({0: 10.0, 1: 20.0})
+            assert await writer.write_registers({0: 10.0, 1: 20.03})
+            assert modbus_server.registers.writes == 1
+            assert await writer.write_registers({0: 10.0, 1: 20.5})
+            assert modbus_server.registers.writes == 2
+            assert await writer.write_registers({0: 10.0, 1: 20.5}, force=True)
+            assert modbus_server.registers.writes == 3
+
+    asyncio.run(scenario())
+    assert modbus_server.registers.getValues(0, 2) == [1000, 2050]
+
+
+def test_writer_reconnects_and_rewrites_everything_after_a_restart(modbus_server):
+    async def scenario():
+        async with AsyncPlcRegisterWriter('127.0.0.1', modbus_server.port, timeout=1, reconnect_attempts=2,
+                                          reconnect_base=0.05) as writer:
+            assert await writer.write_registers({0: 1.0, 1: 2.0})
+            modbus_server.stop()
+            assert not await writer.write_registers({0: 1.5, 1: 2.0})
+            modbus_server.start()
+            assert await writer.write_registers({0: 1.5, 1: 2.0})
+
+    asyncio.run(scenario())
+    # Both registers are rewritten, as the shadow copy is dropped on reconnect
+    assert modbus_server.registers.writes == 2
+    assert modbus_server.registers.getValues(0, 2) == [150, 200]
+
+
+def test_writer_reads_back_the_registers_after_connecting(modbus_server):
+    modbus_server.registers.setValues(0, [1000, 2000])
+    modbus_server.registers.writes = 0
+
+    async def scenario():
+        async with AsyncPlcRegisterWriter('127.0.0.1', modbus_server.port, verify_on_connect=True) as writer:
+            assert await writer.write_registers({0: 10.0, 1: 20.0})
+            assert await writer.write_registers({0: 10.0, 1: 21.0})
+
+    asyncio.run(scenario())
+    assert modbus_server.registers.writes == 1
+    assert modbus_server.registers.getValues(0, 2) == [1000, 2100]
+
+
+def test_writer_fails_without_a_server(closed_port):
+    async def scenario():
+        writer = AsyncPlcRegisterWriter('127.0.0.1', closed_port, timeout=1, reconnect_attempts=1)
+        try:
+            return await writer.write_registers({0: 1.0})
+        finally:
+            await writer.close()
+
+    assert asyncio.run(scenario()) is False
+
+
+def test_writer_writes_bitmasks_as_registers_and_coils(modbus_server):
+    async def scenario():
+        async with AsyncPlcRegisterWriter('127.0.0.1', modbus_server.port) as writer:
+            assert await writer.write_bitmask(10, [1, 0, 1] + [0] * 14 + [1])
+            assert await writer.write_bitmask(0, [1, 0, 1], as_coils=True)
+            assert await writer.write_bitmask(0, [1, 0, 1], as_coils=True)
+
+    asyncio.run(scenario())
+    assert modbus_server.registers.getValues(10, 2) == [0b101, 0b10]
+    assert modbus_server.coils.getValues(0, 3) == [True, False, True]
+    assert modbus_server.coils.writes == 1
+
+
+def test_fanout_reports_each_target(modbus_server, closed_port):
+    targets = plc_targets_from_config([{'NAME': 'up', 'HOST': '127.0.0.1', 'PORT': modbus_server.port},
+                                       {'NAME': 'down', 'HOST': '127.0.0.1', 'PORT': closed_port}])
+
+    async def scenario():
+        async with PlcFanout(targets, timeout=1, reconnect_attempts=1) as fanout:
+            return await fanout.write_signals({'price_difference': 1.0, 'average_price': 2.0})
+
+    assert asyncio.run(scenario()) == {'up': True, 'down': False}
+    assert modbus_server.registers.getValues(0, 2) == [100, 200]
@@ -0,0 +1,122 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+from api_module import HttpClient
+from streaming_module import PriceColumnBuffers, fetch_price_columns, iter_json_records
+
+
+# Hourly Elspotprices records for two price areas, with a missing price and non-ASCII text in every record
+def make_records(count):
+    start = datetime(2024, 3, 1)
+    records = []
+    for index in range(count):
+        hour = start + timedelta(hours=index // 2)
+        records.append({
+            'HourUTC': (hour - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S'),
+            'HourDK': hour.strftime('%Y-%m-%dT%H:%M:%S'),
+            'PriceArea': ('DK1', 'DK2')[index % 2],
+            'SpotPriceDKK': None if index == 3 else round(index * 1.25 - 40, 2),
+            'SpotPriceEUR': None if index == 3 else round(index * 0.17 - 5, 5),
+            'Note': 'Spotpris for Østdanmark – ½ time ☀',
+        })
+    return records
+
+
+# Split a byte string into chunks of the given size
+def split_bytes(body, size):
+    return [body[start:start + size] for start in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1000])
+def test_iter_json_records_across_chunk_boundaries(chunk_size):
+    records = make_records(25)
+    body = json.dumps({'total': 25, 'dataset': 'Elspotprices', 'records': records}, ensure_ascii=False,
+                      indent=1).encode('utf-8')
+    assert list(iter_json_records(split_bytes(body, chunk_size))) == records
+
+
+def test_iter_json_records_splits_multibyte_characters():
+    records = [{'PriceArea': 'Æ☀', 'SpotPriceDKK': 1.5}, {'PriceArea': 'ø', 'SpotPriceDKK': -2}]
+    body = json.dumps({'records': records}, ensure_ascii=False).encode('utf-8')
+    # Cut inside the three bytes of the sun and the two bytes of the Æ
+    sun = body.index('☀'.encode('utf-8'))
+    ae = body.index('Æ'.encode('utf-8'))
+    chunks = [body[:ae + 1], body[ae + 1:sun + 1], body[sun + 1:sun + 2], body[sun + 2:]]
+    assert list(iter_json_records(chunks)) == records
+
+
+def test_iter_json_records_without_records():
+    assert list(iter_json_records([b'{"total": 0, "records": []}'])) == []
+    assert list(iter_json_records([b'{"total": 0, "rec', b'ords": [', b']}'])) == []
+
+
+def test_price_column_buffers_build_typed_columns():
+    records = make_records(6)
+    buffers = PriceColumnBuffers()
+    assert buffers.extend(records) == 6
+    prices_df = buffers.to_frame()
+    assert str(prices_df['HourDK'].dtype) == 'datetime64[s]'
+    assert list(prices_df['PriceArea'].cat.categories) == ['DK1', 'DK2']
+    assert np.isnan(prices_df['SpotPriceDKK'][3])
+    assert prices_df['SpotPriceEUR'][5] == records[5]['SpotPriceEUR']
+
+
+# Local dataset endpoint serving the records page by page for the offset/limit query parameters,
+# in small writes so the client reads the body as a stream
+@pytest.fixture
+def dataset_server():
+    class DatasetHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            offset, limit = int(query['offset'][0]), int(query['limit'][0])
+            self.server.requests.append((offset, limit))
+            page = self.server.records[offset:offset + limit]
+            body = json.dumps({'total': len(self.server.records), 'limit': limit, 'dataset': 'Elspotprices',
+                               'records': page}, ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            for chunk in split_bytes(body, 4099):
+                self.wfile.write(chunk)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DatasetHandler)
+    server.records = []
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('count, page_size, expected_offsets', [
+    (25000, 10000, [0, 10000, 20000]),
+    (20000, 10000, [0, 10000, 20000]),  # a last page of exactly page_size needs one more request
+    (7, 10, [0]),
+    (0, 10, [0]),
+])
+def test_fetch_price_columns_pages(dataset_server, count, page_size, expected_offsets):
+    dataset_server.records = make_records(count)
+    url = f'http://127.0.0.1:{dataset_server.server_address[1]}/dataset/Elspotprices'
+    client = HttpClient(connect_timeout=2, read_timeout=10, max_retries=1)
+    try:
+        prices_df = fetch_price_columns(url, {'start': '2024-03-01'}, client, page_size)
+    finally:
+        client.close()
+
+    assert [offset for offset, _ in dataset_server.requests] == expected_offsets
+    assert {limit for _, limit in dataset_server.requests} == {page_size}
+    assert len(prices_df) == count
+    if count:
+        assert prices_df['HourDK'].iloc[-1] == np.datetime64(dataset_server.records[-1]['HourDK'])
+        assert prices_df['SpotPriceDKK'].iloc[-1] == dataset_server.records[-1]['SpotPriceDKK']
+        assert (prices_df['PriceArea'] == 'DK2').sum() == count // 2